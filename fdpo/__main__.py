@@ -1,18 +1,24 @@
+# Each mode imports the (sometimes slow to load) modules it needs, so that
+# quick modes like `print` and `cost` start fast. See `bench-startup`.
 from .lang import parse, Program, ParseError
 from .check import check, CheckError
-from .smt import InputError, prog_formula, equiv_formula, run, equiv
-from .ask import AskError, Asker, AskConfig
-from .util import parse_env, env_str
-from .bench import bench_run, bench_opt, BenchConfig
+from .util import parse_env, env_str, Env
 from .cost import score
 from . import lib
-from pysmt.shortcuts import to_smtlib
 import sys
 import tomllib
 import os
 import logging
-from typing import Optional
-import asyncio
+from typing import Optional, TextIO, TYPE_CHECKING
+from collections.abc import Iterator
+import csv
+import json
+
+if TYPE_CHECKING:
+    from .ask import Asker, Budget
+    from .bench import BenchConfig
+    from .rules import RuleStore
+    from .gen import GenConfig
 
 LOG = logging.getLogger("fdpo")
 
@@ -45,54 +51,286 @@ def read_progs() -> tuple[Program, Optional[Program]]:
     return prog1, prog2
 
 
-def asker(config: dict) -> Asker:
+def pop_option(args: list[str], name: str) -> Optional[str]:
+    """Remove a `--name VALUE` option from the arguments, returning VALUE."""
+    if name not in args:
+        return None
+    i = args.index(name)
+    try:
+        value = args[i + 1]
+    except IndexError:
+        print(f"error: {name} requires a value", file=sys.stderr)
+        sys.exit(1)
+    del args[i : i + 2]
+    return value
+
+
+def pop_flag(args: list[str], name: str) -> bool:
+    """Remove a `--name` flag from the arguments, reporting its presence."""
+    if name not in args:
+        return False
+    args.remove(name)
+    return True
+
+
+def cache_size(config: dict) -> Optional[int]:
+    """Get the response cache size limit in bytes (configured in MB)."""
+    size = config.get("cache_size")
+    return size * 1024 * 1024 if size is not None else None
+
+
+def budget_config(table: dict) -> "Budget":
+    """Build an agent budget from a config table, like `[budget]`."""
+    from .ask import Budget
+
+    return Budget(**table)
+
+
+def asker(config: dict, replay: bool = False) -> "Asker":
+    from .ask import Asker, AskConfig
+    from .hosts import endpoints
+    from .verify import Verifier
+
     return Asker(
         AskConfig(
-            host=config["host"],
+            host=config.get("host", ""),
             model=config["model"],
             transcript_dir=config.get("transcripts"),
-        )
+            early_stop=config.get("early_stop", True),
+            context_budget=config.get("context_budget"),
+            cache_path=config.get("cache"),
+            cache_size=cache_size(config),
+            replay=replay,
+            samples=config.get("samples", 1),
+            trace_path=config.get("trace"),
+            corpus_dir=config.get("corpus"),
+            corpus_size=config.get("corpus_size", 64),
+            rules_path=config.get("rules"),
+            budget=budget_config(config.get("budget", {})),
+            hosts=endpoints(config.get("hosts", [])),
+        ),
+        Verifier(
+            config.get("workers"),
+            solvers=config.get("solvers"),
+            solver_timeout=config.get("solver_timeout"),
+            recycle=config.get("recycle"),
+        ),
     )
 
 
-def bench_config(config: dict) -> BenchConfig:
+def bench_config(config: dict, replay: bool = False) -> "BenchConfig":
+    from .bench import BenchConfig
+    from .hosts import endpoints
+
     return BenchConfig(
-        host=config["host"],
+        host=config.get("host", ""),
         models=config["bench"]["models"],
         count=config["bench"]["count"],
         transcript_dir=config.get("transcripts"),
         methods=config["bench"]["methods"],
+        workers=config.get("workers"),
+        limit=config["bench"].get("limit"),
+        model_limit=config["bench"].get("model_limit"),
+        cache_path=config.get("cache"),
+        cache_size=cache_size(config),
+        replay=replay,
+        seed=config["bench"].get("seed"),
+        samples=config["bench"].get("samples", config.get("samples", 1)),
+        trace_path=config.get("trace"),
+        store_path=config["bench"].get("store"),
+        batch=config["bench"].get("batch", 1),
+        corpus_dir=config.get("corpus"),
+        corpus_size=config.get("corpus_size", 64),
+        rules_path=config.get("rules"),
+        budget=budget_config(
+            config["bench"].get("budget", config.get("budget", {}))
+        ),
+        hosts=endpoints(config.get("hosts", [])),
+        solvers=config.get("solvers"),
+        solver_timeout=config.get("solver_timeout"),
+        recycle=config.get("recycle"),
+        early_stop=config["bench"].get(
+            "early_stop", config.get("early_stop", True)
+        ),
+        context_budget=config["bench"].get(
+            "context_budget", config.get("context_budget")
+        ),
     )
 
 
+def rule_store(config: dict) -> "RuleStore":
+    """Open the rule database given by `--rules` or the configuration."""
+    from .rules import RuleStore
+
+    path = pop_option(sys.argv, "--rules") or config.get("rules")
+    if not path:
+        print("error: no rule database configured", file=sys.stderr)
+        sys.exit(1)
+    return RuleStore(path)
+
+
+def gen_config(args: list[str]) -> "GenConfig":
+    """Build a program generator configuration from command-line options."""
+    from .gen import GenConfig
+
+    options = {}
+    for name in ("size", "seed", "inputs", "outputs", "window"):
+        if (value := pop_option(args, f"--{name}")) is not None:
+            options[name] = int(value)
+    for name in ("max-depth", "max-fanout"):
+        if (value := pop_option(args, f"--{name}")) is not None:
+            options[name.replace("-", "_")] = int(value)
+    if widths := pop_option(args, "--widths"):
+        options["widths"] = tuple(int(w) for w in widths.split(","))
+    if ops := pop_option(args, "--ops"):
+        # Operators with optional weights, like `add=2,sub,mul=0.5`.
+        options["ops"] = {
+            op: float(weight or 1)
+            for op, _, weight in (o.partition("=") for o in ops.split(","))
+        }
+    return GenConfig(**options)
+
+
+def run_table(prog: Program, path: str, chunk: int = 1000) -> None:
+    """Run a program on rows of inputs from a CSV or JSON-lines file.
+
+    Write the inputs and outputs of each row to stdout in the same format.
+    Rows are run in chunks, each with a single solver instance.
+    """
+    from .smt import run_many, InputError
+    from .util import read_envs
+    import itertools
+
+    def read_chunk(rows: Iterator[Env]) -> list[Env]:
+        try:
+            return list(itertools.islice(rows, chunk))
+        except ValueError as e:
+            raise InputError(f"{path}: {e}")
+
+    json_lines = path.endswith((".jsonl", ".json"))
+    writer = csv.writer(sys.stdout)
+    header = json_lines
+    try:
+        f = open(path)
+    except OSError as e:
+        raise InputError(f"could not read {path}: {e.strerror}")
+    with f:
+        rows = read_envs(f, json_lines)
+        while envs := read_chunk(rows):
+            results = run_many(prog, envs)
+            if not header:
+                writer.writerow([*envs[0], *results[0]])
+                header = True
+            for env, res in zip(envs, results):
+                if json_lines:
+                    print(json.dumps(env | res))
+                else:
+                    writer.writerow([*env.values(), *res.values()])
+            sys.stdout.flush()
+
+
+def batch_requests(
+    op: str, args: list[str], manifest: Optional[str]
+) -> Iterator[dict]:
+    """Generate the requests for a batch operation.
+
+    Requests come from a JSON-lines manifest (where each line is a request
+    for `serve`, with `op` defaulting to the batch's operation) or from
+    filenames. For filenames, any `name=value` arguments are inputs for `run`.
+    Malformed inputs or an unreadable manifest raise ValueError before any
+    request is generated.
+    """
+    inputs = parse_env([a for a in args if "=" in a])
+    try:
+        f = open(manifest) if manifest else None
+    except OSError as e:
+        raise ValueError(f"could not read {manifest}: {e.strerror}")
+    return _batch_requests(op, args, f, inputs)
+
+
+def _batch_requests(
+    op: str, args: list[str], manifest: Optional[TextIO], inputs: Env
+) -> Iterator[dict]:
+    if manifest:
+        with manifest as f:
+            for i, line in enumerate(f):
+                if line.strip():
+                    request = json.loads(line)
+                    request.setdefault("op", op)
+                    request.setdefault("id", request.get("file", i))
+                    yield request
+    for filename in args:
+        if "=" not in filename:
+            yield {
+                "op": op,
+                "file": filename,
+                "id": filename,
+                "inputs": inputs,
+            }
+
+
 def main():
     config = load_config()
     LOG.addHandler(logging.StreamHandler())
     LOG.setLevel(config.get("verbosity", logging.INFO))
 
+    replay = pop_flag(sys.argv, "--replay")
+    profile = pop_option(sys.argv, "--profile")
+    if profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            dispatch(config, replay)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(profile)
+    else:
+        dispatch(config, replay)
+
+
+def dispatch(config: dict, replay: bool):
     mode = sys.argv[1] if len(sys.argv) > 1 else "print"
     match mode:
         case "print":
             prog, _ = read_progs()
             print(prog.pretty())
         case "smt":
+            from .smt import prog_formula
+            from pysmt.shortcuts import to_smtlib
+
             prog, _ = read_progs()
             _, phi = prog_formula(prog)
             print(to_smtlib(phi))
         case "equiv-smt":
+            from .smt import equiv_formula
+            from pysmt.shortcuts import to_smtlib
+
             prog1, prog2 = read_progs()
             assert prog2
             phi = equiv_formula(prog1, prog2)
             print(to_smtlib(phi))
         case "run":
+            from .smt import run, InputError
+
+            inputs_path = pop_option(sys.argv, "--inputs")
             prog, _ = read_progs()
-            inputs = parse_env(sys.argv[2:])
             try:
-                print(env_str(run(prog, inputs)))
+                if inputs_path:
+                    run_table(prog, inputs_path)
+                else:
+                    try:
+                        inputs = parse_env(sys.argv[2:])
+                    except ValueError as e:
+                        raise InputError(str(e))
+                    print(env_str(run(prog, inputs)))
             except InputError as e:
                 print(f"error: {e}", file=sys.stderr)
                 sys.exit(1)
         case "equiv":
+            from .smt import equiv
+
             prog1, prog2 = read_progs()
             assert prog2
             ce = equiv(prog1, prog2)
@@ -102,33 +340,316 @@ def main():
             else:
                 print("equivalent")
         case "ask-run":
+            import asyncio
+
             prog, _ = read_progs()
             inputs = parse_env(sys.argv[2:])
-            print(env_str(asyncio.run(asker(config).run(prog, inputs))))
+            with asker(config, replay) as model:
+                print(env_str(asyncio.run(model.run(prog, inputs))))
         case "ask-opt":
+            import asyncio
+            from .ask import AskError
+
+            parallel = pop_option(sys.argv, "--parallel")
             prog, _ = read_progs()
-            try:
-                new_prog, _ = asyncio.run(asker(config).opt(prog))
-            except AskError as e:
-                print(e, file=sys.stderr)
-                sys.exit(1)
+            with asker(config, replay) as model:
+                if parallel:
+                    par_config = config.get("parallel", {})
+                    task = model.opt_parallel(
+                        prog, int(parallel), limit=par_config.get("limit")
+                    )
+                else:
+                    task = model.opt(prog)
+                try:
+                    new_prog, _, _ = asyncio.run(task)
+                except AskError as e:
+                    print(e, file=sys.stderr)
+                    sys.exit(1)
             print(new_prog.pretty())
         case "ask-opt-oneshot":
+            import asyncio
+            from .ask import AskError
+
             prog, _ = read_progs()
-            try:
-                new_prog = asyncio.run(asker(config).opt_oneshot(prog))
-            except AskError as e:
-                print(e, file=sys.stderr)
-                sys.exit(1)
+            with asker(config, replay) as model:
+                try:
+                    new_prog = asyncio.run(model.opt_oneshot(prog))
+                except AskError as e:
+                    print(e, file=sys.stderr)
+                    sys.exit(1)
             print(new_prog.pretty())
         case "bench-run":
+            import asyncio
+            from .bench import bench_run
+
             filenames = sys.argv[2:]
-            count = config["bench"]["count"]
-            asyncio.run(bench_run(filenames, bench_config(config)))
+            asyncio.run(bench_run(filenames, bench_config(config, replay)))
         case "bench-opt":
+            import asyncio
+            from .bench import bench_opt
+
             filenames = sys.argv[2:]
-            count = config["bench"]["count"]
-            asyncio.run(bench_opt(filenames, bench_config(config)))
+            asyncio.run(bench_opt(filenames, bench_config(config, replay)))
+        case "bench-report":
+            from .store import ResultStore
+
+            path = sys.argv[2] if len(sys.argv) > 2 else None
+            path = path or config.get("bench", {}).get("store")
+            if not path:
+                print("error: no results store configured", file=sys.stderr)
+                sys.exit(1)
+            writer = csv.writer(sys.stdout)
+            writer.writerow(
+                [
+                    "prog",
+                    "model",
+                    "method",
+                    "runs",
+                    "successes",
+                    "mean_cost",
+                    "best_cost",
+                    "mean_rounds",
+                    "mean_seconds",
+                ]
+            )
+            with ResultStore(path) as results:
+                for row in results.report():
+                    writer.writerow(
+                        f"{v:.2f}" if isinstance(v, float) else v for v in row
+                    )
+        case "bench-cost":
+            from . import microbench
+
+            sizes = [int(a) for a in sys.argv[2:]] or [100, 1000, 10000]
+            writer = csv.writer(sys.stdout)
+            writer.writerow(["size", "cold_us", "warm_us", "one_change_us"])
+            for size in sizes:
+                res = microbench.bench_cost(size)
+                writer.writerow([size] + [f"{v:.1f}" for v in res.values()])
+        case "bench-smt":
+            from . import microbench
+
+            as_json = pop_flag(sys.argv, "--json")
+            baseline = pop_option(sys.argv, "--baseline")
+            threshold = float(pop_option(sys.argv, "--threshold") or 1.25)
+            reps = int(pop_option(sys.argv, "--reps") or 20)
+            sizes = pop_option(sys.argv, "--sizes")
+            rows = microbench.bench_stages(
+                sys.argv[2:],
+                [int(s) for s in sizes.split(",") if s]
+                if sizes is not None
+                else [10, 100],
+                reps,
+            )
+            if not rows:
+                print("error: no programs to benchmark", file=sys.stderr)
+                sys.exit(1)
+            if as_json:
+                json.dump(rows, sys.stdout, indent=2)
+                print()
+            else:
+                writer = csv.DictWriter(sys.stdout, list(rows[0]))
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow(
+                        {
+                            k: f"{v:.1f}" if isinstance(v, float) else v
+                            for k, v in row.items()
+                        }
+                    )
+            if baseline:
+                with open(baseline) as f:
+                    slow = microbench.regressions(
+                        rows, json.load(f), threshold
+                    )
+                for stage, name, old, new in slow:
+                    print(
+                        f"regression: {stage} on {name}: "
+                        f"{old:.1f}us -> {new:.1f}us",
+                        file=sys.stderr,
+                    )
+                if slow:
+                    sys.exit(1)
+        case "bench-startup":
+            from . import microbench
+
+            max_ms = pop_option(sys.argv, "--max-import-ms")
+            reps = int(pop_option(sys.argv, "--reps") or 5)
+            rows = microbench.bench_startup(reps)
+            if not rows:
+                print("error: no modes to benchmark", file=sys.stderr)
+                sys.exit(1)
+            writer = csv.DictWriter(sys.stdout, list(rows[0]))
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(
+                    {
+                        k: f"{v:.1f}" if isinstance(v, float) else v
+                        for k, v in row.items()
+                    }
+                )
+            if max_ms:
+                slow = [r for r in rows if r["import_ms"] > float(max_ms)]
+                for row in slow:
+                    print(
+                        f"regression: {row['mode']} imports take "
+                        f"{row['import_ms']:.1f}ms",
+                        file=sys.stderr,
+                    )
+                if slow:
+                    sys.exit(1)
+        case "mock-serve":
+            import asyncio
+            from .mock import serve, mock_config
+
+            port = int(pop_option(sys.argv, "--port") or 11435)
+            LOG.info("mock server listening on port %i", port)
+            asyncio.run(
+                serve(mock_config(config.get("mock", {})), "127.0.0.1", port)
+            )
+        case "bench-harness":
+            import asyncio
+            from .bench import bench_harness
+            from .mock import mock_config
+
+            hosts = int(pop_option(sys.argv, "--hosts") or 1)
+            dead = int(pop_option(sys.argv, "--dead") or 0)
+            filename = sys.argv[2]
+            counts = [int(a) for a in sys.argv[3:]] or [1, 10, 100]
+            asyncio.run(
+                bench_harness(
+                    filename,
+                    counts,
+                    mock_config(config.get("mock", {})),
+                    hosts,
+                    dead,
+                )
+            )
+        case "bench-soak":
+            import asyncio
+            from .bench import bench_soak
+            from .mock import mock_config
+
+            concurrency = int(pop_option(sys.argv, "--concurrency") or 10)
+            every = int(pop_option(sys.argv, "--every") or 100)
+            filename = sys.argv[2]
+            sessions = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+            # Unless configured otherwise, the mock answers instantly.
+            mock = {"rate": 1e5, "latency": 0.0} | config.get("mock", {})
+            asyncio.run(
+                bench_soak(
+                    filename,
+                    sessions,
+                    mock_config(mock),
+                    concurrency,
+                    every,
+                    solvers=config.get("solvers"),
+                    recycle=config.get("recycle"),
+                    transcript_dir=config.get("transcripts"),
+                )
+            )
+        case "hosts":
+            import asyncio
+            from .hosts import HostPool, Endpoint, endpoints
+
+            pool = HostPool(
+                endpoints(config.get("hosts", []))
+                or [Endpoint(config.get("host", ""))]
+            )
+            writer = csv.writer(sys.stdout)
+            writer.writerow(["host", "weight", "latency_ms"])
+            for host, latency in zip(pool.hosts, asyncio.run(pool.check())):
+                writer.writerow(
+                    [
+                        host.endpoint.url,
+                        host.endpoint.weight,
+                        "down" if latency is None else f"{latency * 1000:.1f}",
+                    ]
+                )
+        case "serve":
+            import asyncio
+            from contextlib import nullcontext
+            from .serve import Server
+            from .verify import Verifier
+
+            path = pop_option(sys.argv, "--socket")
+            model = asker(config, replay) if "model" in config else None
+            verifier = (
+                model.verifier
+                if model
+                else Verifier(
+                    config.get("workers"), recycle=config.get("recycle")
+                )
+            )
+            with verifier, model or nullcontext():
+                server = Server(verifier, model)
+                if path:
+                    asyncio.run(server.serve_unix(path))
+                else:
+                    asyncio.run(server.serve_stdio())
+        case "batch":
+            import asyncio
+            from .serve import Server
+            from .verify import Verifier
+
+            manifest = pop_option(sys.argv, "--manifest")
+            ordered = not pop_flag(sys.argv, "--unordered")
+            op = sys.argv[2]
+            try:
+                requests = batch_requests(op, sys.argv[3:], manifest)
+            except ValueError as e:
+                print(f"error: {e}", file=sys.stderr)
+                sys.exit(1)
+            failures = 0
+
+            def write(result: dict) -> None:
+                nonlocal failures
+                failures += not result["ok"]
+                print(json.dumps(result), flush=True)
+
+            with Verifier(
+                config.get("workers"), recycle=config.get("recycle")
+            ) as verifier:
+                server = Server(verifier)
+                asyncio.run(server.batch(requests, write, ordered))
+            if failures:
+                sys.exit(1)
+        case "mine":
+            from .rules import mine
+
+            prog1, prog2 = read_progs()
+            assert prog2
+            for rule in mine(prog1, prog2):
+                print(rule.pretty())
+        case "learn":
+            from .rules import mine
+
+            store = rule_store(config)
+            prog1, prog2 = read_progs()
+            assert prog2
+            for rule in mine(prog1, prog2):
+                if store.add(rule):
+                    print(rule.pretty())
+            store.close()
+        case "rewrite":
+            from .rules import heads, rewrite
+
+            store = rule_store(config)
+            prog, _ = read_progs()
+            new_prog, count = rewrite(prog, store.lookup(heads(prog)))
+            LOG.info("applied %i rewrites", count)
+            print(new_prog.pretty())
+            store.close()
+        case "rules":
+            store = rule_store(config)
+            for rule in store.all():
+                print(f"{rule.pretty()}  # gain {rule.gain()}")
+            store.close()
+        case "gen":
+            from . import gen
+
+            variant = pop_flag(sys.argv, "--variant")
+            gen.write(gen_config(sys.argv), sys.stdout, variant)
         case "lib-help":
             print("\n".join(f.help for f in lib.FUNCTIONS.values()))
         case "cost":
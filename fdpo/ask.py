@@ -1,21 +1,30 @@
 import asyncio
-from ollama import AsyncClient
 import tomllib
 import jinja2
-from . import lang, smt, lib, check, cost
-from .util import Env, parse_env, env_str
+from . import lang, smt, lib, check, cost, verify, trace, diff, rules
+from .cache import ResponseCache, cache_key
+from .corpus import Corpus
+from .hosts import Endpoint, HostPool
+from .solver import SolverError
+from .util import Env, parse_env_rows, env_str
 import re
 import logging
 import sys
-from typing import Optional, assert_never
+from typing import Optional, Any, assert_never
+from collections.abc import AsyncIterator, Callable
 from dataclasses import dataclass
 import datetime
+import itertools
+import json
 import os
+import time
 
 LOG = logging.getLogger("fdpo")
 MAX_ERRORS = 5
 MAX_ROUNDS = 20
+LOCAL_FRACTION = 0.5  # Largest changed fraction to verify locally.
 OPS = ["check", "eval", "cost", "commit"]
+FENCE_RE = re.compile(r"^\s*```+\s*$", re.M)
 
 
 def parse_env_lines(s: str) -> dict[str, int]:
@@ -24,9 +33,34 @@ def parse_env_lines(s: str) -> dict[str, int]:
     }
 
 
+def parse_table(s: str) -> dict[int, dict[str, int]]:
+    """Parse the rows of Markdown tables of integers, keyed by their headers.
+
+    Rows are numbered by their `#` column. Later tables take precedence.
+    """
+    rows = {}
+    header = None
+    for line in s.splitlines():
+        line = line.strip()
+        if not line.startswith("|"):
+            header = None
+            continue
+        cells = [c.strip().strip("`") for c in line.strip("|").split("|")]
+        if header is None:
+            header = cells
+            continue
+        try:
+            row = dict(zip(header, (int(c) for c in cells)))
+        except ValueError:
+            continue  # A separator or some other non-numeric row.
+        if "#" in row:
+            rows[row.pop("#")] = row
+    return rows
+
+
 def extract_code(s: str) -> Optional[str]:
     """Extract a Markdown fenced code block from the string."""
-    parts = re.split(r"^\s*```+\s*$", s, 2, re.M)
+    parts = FENCE_RE.split(s, 2)
     if len(parts) >= 3:
         return parts[1].strip()
     elif len(parts) == 2:
@@ -39,15 +73,41 @@ def same_sig(prog1: lang.Program, prog2: lang.Program) -> bool:
     return prog1.inputs == prog2.inputs and prog1.outputs == prog2.outputs
 
 
+@dataclass(frozen=True)
+class Budget:
+    """When an agent conversation should give up or stop early."""
+
+    rounds: int = MAX_ROUNDS
+    errors: int = MAX_ERRORS  # Consecutive malformed responses.
+    seconds: Optional[float] = None
+    tokens: Optional[int] = None  # Generated tokens.
+    patience: Optional[int] = None  # Rounds without a cost improvement.
+    target_cost: Optional[int] = None
+
+
 @dataclass(frozen=True)
 class AskConfig:
     host: str
     model: str
     transcript_dir: Optional[str]
+    early_stop: bool = True
+    context_budget: Optional[int] = None
+    cache_path: Optional[str] = None
+    cache_size: Optional[int] = None  # Bytes.
+    replay: bool = False
+    samples: int = 1  # Candidate responses to request in each round.
+    trace_path: Optional[str] = None  # Append per-round JSON-lines records.
+    corpus_dir: Optional[str] = None  # Persist counterexample corpora.
+    corpus_size: int = 64  # Inputs to keep per program.
+    budget: Budget = Budget()
+    rules_path: Optional[str] = None  # A database of learned rewrite rules.
+    hosts: tuple[Endpoint, ...] = ()  # Balance requests across these instead.
 
 
 class AskError(Exception):
-    pass
+    def __init__(self, message: str, stop_reason: str = "failed"):
+        super().__init__(message)
+        self.stop_reason = stop_reason  # Why an agent conversation ended.
 
 
 @dataclass(frozen=True)
@@ -60,11 +120,11 @@ class CheckCommand:
 
 @dataclass(frozen=True)
 class EvalCommand:
-    env: Env
+    envs: list[Env]
     prog: lang.Program
 
     def log(self) -> str:
-        return f"eval({env_str(self.env)})"
+        return f"eval({'; '.join(env_str(env) for env in self.envs)})"
 
 
 @dataclass(frozen=True)
@@ -115,10 +175,10 @@ def parse_command(s: str) -> Command:
             return CheckCommand(prog)
         case "eval":
             try:
-                env = parse_env(args)
+                envs = parse_env_rows(args)
             except ValueError as exc:
                 raise CommandError(f"invalid evaluation value: {exc}")
-            return EvalCommand(env, prog)
+            return EvalCommand(envs, prog)
         case "cost":
             return CostCommand(prog)
         case "commit":
@@ -157,11 +217,73 @@ def parse_resp_prog(s: str) -> lang.Program:
         raise AskError(f"syntax error: {e}")
 
 
+def command_complete(s: str) -> bool:
+    """Check whether a partial response contains a complete command."""
+    if len(FENCE_RE.findall(s)) < 2:
+        return False
+    try:
+        parse_resp_command(s)
+    except CommandError:
+        return False
+    return True
+
+
+def prog_complete(s: str) -> bool:
+    """Check whether a partial response contains a complete program."""
+    if len(FENCE_RE.findall(s)) < 2:
+        return False
+    try:
+        parse_resp_prog(s)
+    except AskError:
+        return False
+    return True
+
+
+@dataclass(frozen=True)
+class RoundStats:
+    """Measurements for a single streamed model response."""
+
+    latency: float  # Seconds from the request to the last part.
+    ttft: Optional[float]  # Seconds from the request to the first part.
+    parts: int  # Streamed parts (roughly, tokens) received.
+    complete_at: Optional[int]  # Parts received when the answer was done.
+    stopped_early: bool
+
+    @property
+    def trailing(self) -> int:
+        """The number of parts received after the answer was complete.
+
+        With early stopping disabled, this counts the parts that early
+        stopping would have saved.
+        """
+        if self.complete_at is None:
+            return 0
+        return self.parts - self.complete_at
+
+
+def estimate_tokens(message: dict) -> int:
+    """Roughly estimate the number of tokens in a chat message."""
+    return len(message["content"]) // 4 + 1
+
+
 class Chat:
-    def __init__(self, asker: "Asker", transcript_dir: Optional[str] = None):
+    def __init__(
+        self,
+        asker: "Asker",
+        transcript_dir: Optional[str] = None,
+        budget: Optional[int] = None,
+    ):
         self.asker = asker
         self.history = []
 
+        # With a token budget, old exchanges are collapsed into one-line
+        # summaries (keyed by the index of the assistant message they
+        # summarize). Everything in the history before `cut`, except the
+        # leading system prompt, is elided.
+        self.budget = budget
+        self.summaries: dict[int, str] = {}
+        self.cut = 0
+
         if transcript_dir:
             os.makedirs(transcript_dir, exist_ok=True)
             tstamp = datetime.datetime.now().isoformat()
@@ -174,13 +296,68 @@ class Chat:
         if self.transcript_file:
             print(s, end=end, file=self.transcript_file, flush=True)
 
+    def close(self) -> None:
+        """End the conversation, releasing its history and transcript."""
+        if self.transcript_file:
+            self.transcript_file.close()
+            self.transcript_file = None
+        self.history = []
+        self.summaries = {}
+        self.cut = 0
+
+    def messages(self) -> list[dict]:
+        """Get the messages to send, fitting within the token budget.
+
+        The system prompt always comes first, unchanged, so it remains a
+        cacheable prefix. When the budget is exceeded, old exchanges are
+        replaced by a summary. To keep that summary stable for several
+        rounds, we collapse enough to use at most half the budget.
+        """
+        if self.budget is None:
+            return self.history
+
+        prefix_len = 0
+        while (
+            prefix_len < len(self.history)
+            and self.history[prefix_len]["role"] == "system"
+        ):
+            prefix_len += 1
+        prefix = self.history[:prefix_len]
+        self.cut = max(self.cut, prefix_len)
+        room = self.budget - sum(estimate_tokens(m) for m in prefix)
+
+        def used() -> int:
+            return sum(estimate_tokens(m) for m in self.history[self.cut :])
+
+        if used() > room:
+            # Elide whole exchanges, but always keep the latest message.
+            while used() > room // 2 and self.cut + 2 < len(self.history):
+                self.cut += 2
+
+        summaries = [s for i, s in self.summaries.items() if i < self.cut]
+        if not summaries:
+            return prefix + self.history[self.cut :]
+        summary = {
+            "role": "system",
+            "content": self.asker.prompt("summary.md", summaries=summaries),
+        }
+        return prefix + [summary] + self.history[self.cut :]
+
     def system(self, message: str) -> None:
         LOG.debug(
             "Adding system prompt (hist. %i):\n%s", len(self.history), message
         )
         self.history.append({"role": "system", "content": message})
 
-    async def send(self, message: str) -> str:
+    async def send(
+        self, message: str, complete: Optional[Callable[[str], bool]] = None
+    ) -> str:
+        """Send a message and get the response.
+
+        If `complete` is given, it is called on the response received so far
+        whenever a code fence arrives. Once it returns True, generation may be
+        stopped early.
+        """
         LOG.debug(
             "Sending message (hist. %i):\n%s", len(self.history), message
         )
@@ -189,72 +366,278 @@ class Chat:
         self.transcribe("\n---\n")
 
         self.history.append({"role": "user", "content": message})
-        resp = await self.asker.client.chat(
-            model=self.asker.model, messages=self.history, stream=True
+        out_s = await self.respond(self.messages(), complete)
+        self.history.append({"role": "assistant", "content": out_s})
+        return out_s
+
+    async def send_many(
+        self,
+        message: str,
+        count: int,
+        complete: Optional[Callable[[str], bool]] = None,
+    ) -> list[str]:
+        """Send a message and sample several responses, concurrently.
+
+        Each response uses a different sampling seed. The first response is
+        added to the history; callers may replace it with another one.
+        """
+        LOG.debug(
+            "Sending message for %i samples (hist. %i):\n%s",
+            count,
+            len(self.history),
+            message,
         )
+        self.transcribe(f"# round {len(self.history) // 2}\n")
+        self.transcribe(message)
+        self.transcribe("\n---\n")
 
-        out = []
-        LOG.debug("Receiving response.")
-        self.transcribe("````")
-        async for part in resp:  # type: ignore
-            text = part["message"]["content"]
-            if LOG.level <= logging.DEBUG:
-                print(text, end="", file=sys.stderr, flush=True)
-            self.transcribe(text, end="")
-            out.append(text)
-        if LOG.level <= logging.DEBUG:
-            print(file=sys.stderr, flush=True)
-        self.transcribe("\n````\n")
+        self.history.append({"role": "user", "content": message})
+        messages = self.messages()
+        resps = await asyncio.gather(
+            *(
+                self.respond(messages, complete, {"seed": i}, False)
+                for i in range(count)
+            )
+        )
+        for resp in resps:
+            self.transcribe(f"````\n{resp}\n````\n")
+        self.history.append({"role": "assistant", "content": resps[0]})
+        return resps
 
-        LOG.debug("Response finished with %s parts.", len(out))
-        out_s = "".join(out)
-        self.history.append({"role": "assistant", "content": out_s})
+    async def respond(
+        self,
+        messages: list[dict],
+        complete: Optional[Callable[[str], bool]] = None,
+        options: Optional[dict] = None,
+        transcribe: bool = True,
+    ) -> str:
+        """Get a single response to a list of messages."""
+        request: dict[str, Any] = {"messages": messages}
+        if options:
+            request["options"] = options
+        key = self.asker.cache_key("chat", **request)
+        if (cached := self.asker.cache_get(key)) is not None:
+            if transcribe:
+                self.transcribe(f"````\n{cached}\n```` (cached)\n")
+            return cached
+
+        start = time.perf_counter()
+        # Keep the conversation on one host, which caches its prompt.
+        resp = await self.asker.pool.chat(
+            self, model=self.asker.model, **request
+        )
+
+        if transcribe:
+            self.transcribe("````")
+        out_s, stats = await self.asker.collect(
+            resp,  # type: ignore
+            lambda part: part["message"]["content"],
+            start,
+            complete,
+            self.transcribe if transcribe else None,
+        )
+        if transcribe:
+            if stats.stopped_early:
+                self.transcribe("\n```` (stopped early)\n")
+            else:
+                self.transcribe("\n````\n")
+
+        self.asker.cache_put(key, out_s)
         return out_s
 
 
+class Board:
+    """Shared state for several agents optimizing the same program.
+
+    The board caches equivalence-checking results for every candidate any
+    agent has proposed and tracks the best verified program overall. Before
+    calling the solver, it tries a candidate on a corpus of past
+    counterexamples.
+    """
+
+    def __init__(
+        self,
+        prog: lang.Program,
+        verifier: verify.Verifier,
+        target_cost: Optional[int] = None,
+        corpus: Optional[Corpus] = None,
+    ):
+        self.prog = prog
+        self.verifier = verifier
+        self.target_cost = target_cost
+        self.corpus = corpus if corpus is not None else Corpus(prog)
+        self.verified: dict[lang.Program, Optional[smt.Counterexample]] = {}
+        self.best_prog: Optional[lang.Program] = None
+        self.done = asyncio.Event()
+
+    def corpus_check(self, prog: lang.Program) -> bool:
+        """Try to refute a candidate with the corpus, filling the cache."""
+        with trace.span("corpus"):
+            ce = self.corpus.check(prog)
+        if ce:
+            trace.count("wrong")
+            trace.count("corpus_caught")
+            self.verified[prog] = ce
+        return ce is not None
+
+    def record(self, prog: lang.Program, ce: Optional[smt.Counterexample]):
+        """Record a solver result, adding any counterexample to the corpus."""
+        self.verified[prog] = ce
+        if ce:
+            trace.count("wrong")
+            self.corpus.add(ce.inputs)
+
+    def nearest(self, prog: lang.Program) -> Optional[diff.Region]:
+        """Find the smallest change from a verified program to a candidate."""
+        best = None
+        for other, ce in [(self.prog, None), *self.verified.items()]:
+            if ce is None and (region := diff.region(other, prog)):
+                if best is None or region.size() < best.size():
+                    best = region
+        return best
+
+    async def local_check(self, prog: lang.Program) -> bool:
+        """Try to verify a candidate by checking only what it changed.
+
+        A candidate that changes a small region of some program that is
+        already known to be equivalent is equivalent if the region is. A
+        counterexample for the region might not be reachable, though, so a
+        failed local check is inconclusive. Return True if it succeeds.
+        """
+        region = self.nearest(prog)
+        if region is None:
+            return False
+        total = len(self.prog.assignments) + len(prog.assignments)
+        if region.size() > total * LOCAL_FRACTION:
+            return False
+        try:
+            if await self.verifier.equiv(region.old, region.new):
+                trace.count("local_inconclusive")
+                return False
+        except SolverError:
+            return False  # Leave it to the full check.
+        trace.count("local_proved")
+        self.verified[prog] = None
+        return True
+
+    async def equiv(self, prog: lang.Program) -> Optional[smt.Counterexample]:
+        """Check a candidate against the original, using the cache."""
+        if (
+            prog not in self.verified
+            and not self.corpus_check(prog)
+            and not await self.local_check(prog)
+        ):
+            self.record(prog, await self.verifier.equiv(self.prog, prog))
+        return self.verified[prog]
+
+    async def equiv_many(self, progs: list[lang.Program]) -> None:
+        """Check several candidates at once, filling the cache."""
+        new = [
+            p
+            for p in dict.fromkeys(progs)
+            if p not in self.verified and not self.corpus_check(p)
+        ]
+        local = await asyncio.gather(*(self.local_check(p) for p in new))
+        new = [p for p, done in zip(new, local) if not done]
+        if new:
+            results = await self.verifier.equiv_many(self.prog, new)
+            for prog, ce in zip(new, results):
+                self.record(prog, ce)
+
+    def offer(self, prog: lang.Program) -> None:
+        """Record a verified program, which might be the new global best."""
+        score = cost.score(prog)
+        if self.best_prog is None or score < cost.score(self.best_prog):
+            self.best_prog = prog
+            if self.target_cost is not None and score <= self.target_cost:
+                LOG.info("   reached target cost: %i", score)
+                self.done.set()
+
+
 class OptChat(Chat):
     def __init__(
         self,
         asker: "Asker",
         prog: lang.Program,
         transcript_dir: Optional[str] = None,
+        board: Optional[Board] = None,
     ):
-        super().__init__(asker, transcript_dir)
+        super().__init__(asker, transcript_dir, asker.context_budget)
         self.prog = prog
         self.best_prog: Optional[lang.Program] = None
+        self.board = board or asker.board(prog)
+        self.rounds = 0
+        self.improved_at = 0  # The round when the best cost last improved.
+        self.run_budget = asker.budget
+        self.stop_reason = ""  # Why the conversation ended.
+        self.outcome = ""  # A short description of the last command's result.
+        self.session = next(asker.sessions)
 
     def prompt(self, name: str, **kwargs) -> str:
         return self.asker.prompt(
             name, prog=self.prog, best_prog=self.best_prog, ops=OPS, **kwargs
         )
 
-    async def get_command(self, prompt: str) -> Command:
-        resp = await self.send(prompt)
-        for _ in range(MAX_ERRORS):
-            try:
-                return parse_resp_command(resp)
-            except CommandError as e:
-                LOG.info("   malformed command: %s", e)
-                resp = await self.send(
-                    self.prompt("malformed_command.md", error=str(e))
-                )
-        raise AskError(f"exceeded {MAX_ERRORS} interaction errors")
+    async def sample(self, prompt: str) -> list[str]:
+        """Get one response to a prompt, or several when sampling."""
+        if self.asker.samples == 1:
+            return [await self.send(prompt, command_complete)]
+        return await self.send_many(
+            prompt, self.asker.samples, command_complete
+        )
+
+    async def get_commands(self, prompt: str) -> list[Command]:
+        """Get the next command, or several candidates when sampling."""
+        start = len(self.history)
+        resps = await self.sample(prompt)
+        for _ in range(self.run_budget.errors):
+            cmds = {}
+            errors = []
+            for resp in resps:
+                try:
+                    cmd = parse_resp_command(resp)
+                except CommandError as e:
+                    errors.append(e)
+                else:
+                    # Skip duplicate samples.
+                    cmds.setdefault(repr(cmd), (cmd, resp))
+            if cmds:
+                # Record a valid command as the model's response.
+                _, resp = next(iter(cmds.values()))
+                self.history[-1] = {"role": "assistant", "content": resp}
+                if self.budget is not None and len(self.history) > start + 2:
+                    # Drop the malformed exchanges, keeping the original
+                    # prompt and the final, valid response.
+                    del self.history[start + 1 : -1]
+                return [cmd for cmd, _ in cmds.values()]
+
+            LOG.info("   malformed command: %s", errors[0])
+            resps = await self.sample(
+                self.prompt("malformed_command.md", error=str(errors[0]))
+            )
+        self.stop_reason = "errors"
+        raise AskError(
+            f"exceeded {self.run_budget.errors} interaction errors", "errors"
+        )
 
     def well_formed(self, prog: lang.Program) -> Optional[str]:
         try:
-            check.check(prog)
+            with trace.span("check"):
+                check.check(prog)
         except check.CheckError as e:
             LOG.info("   ill-formed: %s", e)
+            self.outcome = f"ill-formed ({e})"
             return self.prompt("illformed.md", error=str(e))
         return None
 
-    def _check_equiv(self, prog: lang.Program) -> Optional[str]:
+    async def _check_equiv(self, prog: lang.Program) -> Optional[str]:
         """Check program equivalence.
 
         Return a message if the programs are not equivalent, or None if they are.
         """
         # Check that the two programs have the same input/output ports.
         if not same_sig(self.prog, prog):
+            self.outcome = "wrong input/output ports"
             return self.prompt("signature_mismatch.md")
 
         # Check that the program is well-formed.
@@ -264,104 +647,300 @@ class OptChat(Chat):
         # Check for an identical program.
         if self.prog == prog:
             LOG.info("   identical")
+            self.outcome = "identical to the original"
             return self.prompt("identical.md")
 
         # Check equivalence.
-        ce = smt.equiv(self.prog, prog)
+        try:
+            ce = await self.board.equiv(prog)
+        except SolverError as e:
+            LOG.info(f"   {e}")
+            self.outcome = str(e)
+            return self.prompt("solver_error.md", error=e)
         if ce:
             LOG.info("   not equivalent")
+            self.outcome = f"not equivalent, counterexample {ce.compact()}"
             return self.prompt("counterexample.md", ce=ce)
         else:
             LOG.info("   equivalent")
             # Save the new best equivalent program.
             score = cost.score(prog)
+            self.outcome = f"equivalent, cost {score}"
             if self.best_prog is None or score < cost.score(self.best_prog):
                 LOG.info(f"   new best cost: {score}")
                 self.best_prog = prog
+                self.improved_at = self.rounds
+            self.board.offer(prog)
             return None
 
-    def check(self, cmd: CheckCommand) -> str:
-        resp = self._check_equiv(cmd.prog)
+    async def check(self, cmd: CheckCommand) -> str:
+        resp = await self._check_equiv(cmd.prog)
         if resp:
             return resp
         return self.prompt("equivalent.md")
 
-    def commit(self, cmd: CommitCommand) -> Optional[str]:
+    async def commit(self, cmd: CommitCommand) -> Optional[str]:
         """Perform a `commit` command for the agent.
 
         Return None if the interaction is done.
         """
-        resp = self._check_equiv(cmd.prog)
+        resp = await self._check_equiv(cmd.prog)
         if resp:
             return resp
         if cost.score(cmd.prog) >= cost.score(self.prog):
+            self.outcome += ", but not cheaper than the original"
             return self.prompt("cost.md", new_prog=cmd.prog)
         return None
 
-    def eval(self, cmd: EvalCommand) -> str:
+    async def eval(self, cmd: EvalCommand) -> str:
         """Perform an `eval` command for the agent."""
         # Check that the program is well-formed.
         if err := self.well_formed(cmd.prog):
             return err
 
         # Silently ignore extra inputs.
-        env = {k: v for k, v in cmd.env.items() if k in cmd.prog.inputs}
+        envs = [
+            {k: v for k, v in env.items() if k in cmd.prog.inputs}
+            for env in cmd.envs
+        ]
 
-        # Run the program.
+        # Run the program on every row at once.
         try:
-            res = smt.run(cmd.prog, env)
+            if len(envs) == 1:
+                results = [await self.asker.verifier.run(cmd.prog, envs[0])]
+            else:
+                results = await self.asker.verifier.run_many(cmd.prog, envs)
         except smt.InputError as e:
             LOG.info(f"   input error: {e}")
+            self.outcome = f"input error ({e})"
             return self.prompt(
                 "input_error.md", error=str(e), new_prog=cmd.prog
             )
-        return self.prompt("eval.md", env=res)
+        except SolverError as e:
+            LOG.info(f"   {e}")
+            self.outcome = str(e)
+            return self.prompt("solver_error.md", error=e)
+        if len(results) == 1:
+            self.outcome = env_str(results[0]).replace("\n", ", ")
+            return self.prompt("eval.md", env=results[0])
+        self.outcome = f"{len(results)} rows"
+        return self.prompt(
+            "eval_table.md",
+            rows=[env | res for env, res in zip(envs, results)],
+            inputs=list(cmd.prog.inputs),
+            outputs=list(cmd.prog.outputs),
+        )
 
     def cost(self, cmd: CostCommand) -> str:
         if err := self.well_formed(cmd.prog):
             return err
+        self.outcome = f"cost {cost.score(cmd.prog)}"
         return self.prompt("cost.md", new_prog=cmd.prog)
 
+    async def execute(self, cmd: Command) -> Optional[str]:
+        """Execute a command, returning the response for the agent.
+
+        Return None if the interaction is done.
+        """
+        match cmd:
+            case CheckCommand(_):
+                return await self.check(cmd)
+            case EvalCommand(_, _):
+                return await self.eval(cmd)
+            case CostCommand(_):
+                return self.cost(cmd)
+            case CommitCommand(_):
+                return await self.commit(cmd)
+            case _:
+                assert_never(cmd)
+
+    async def execute_batch(
+        self, round: int, cmds: list[Command]
+    ) -> tuple[Optional[str], str]:
+        """Execute several candidate commands from one round.
+
+        Return a combined response (or None if the interaction is done) and
+        a summary of the results.
+        """
+        # Verify all the well-formed candidate programs together.
+        progs = []
+        for cmd in cmds:
+            if isinstance(cmd, (CheckCommand, CommitCommand)):
+                if same_sig(self.prog, cmd.prog) and cmd.prog != self.prog:
+                    try:
+                        with trace.span("check"):
+                            check.check(cmd.prog)
+                    except check.CheckError:
+                        continue
+                    progs.append(cmd.prog)
+        try:
+            await self.board.equiv_many(progs)
+        except SolverError as e:
+            # Fall back to checking the candidates one at a time.
+            LOG.info(f"   {e}")
+
+        results = []
+        for i, cmd in enumerate(cmds):
+            LOG.info("%i.%i. %s", round + 1, i + 1, cmd.log())
+            if await self.execute(cmd) is None:
+                return None, cmd.log()
+            results.append(f"{cmd.log()}: {self.outcome}".replace("\n", ", "))
+        resp = self.prompt("batch.md", results=results)
+        return resp, "; ".join(results)
+
+    def over_budget(self, start: float, tokens: int) -> Optional[str]:
+        """Check whether the conversation should stop, and why."""
+        budget = self.run_budget
+        if self.best_prog is not None:
+            score = cost.score(self.best_prog)
+            if score == 0:
+                return "optimal"  # Nothing is cheaper than free.
+            if budget.target_cost is not None and score <= budget.target_cost:
+                return "target"
+        if self.rounds >= budget.rounds:
+            return "rounds"
+        if budget.seconds is not None:
+            if time.perf_counter() - start >= budget.seconds:
+                return "seconds"
+        if budget.tokens is not None and tokens >= budget.tokens:
+            return "tokens"
+        if budget.patience is not None:
+            if self.rounds - self.improved_at >= budget.patience:
+                return "stalled"
+        return None
+
+    async def seed(self) -> None:
+        """Start from the program as rewritten by learned rules."""
+        new_prog = self.asker.apply_rules(self.prog)
+        if new_prog and not await self.board.equiv(new_prog):
+            score = cost.score(new_prog)
+            LOG.info("   rules reached cost: %i", score)
+            self.best_prog = new_prog
+            self.board.offer(new_prog)
+
     async def run(self) -> tuple[lang.Program, int]:
-        self.system(self.prompt("opt_agent.md"))
-        cmd = await self.get_command("Enter your first command:")
-
-        round = -1
-        for round in range(MAX_ROUNDS):
-            LOG.info("%i. %s", round + 1, cmd.log())
-            match cmd:
-                case CheckCommand(_):
-                    resp = self.check(cmd)
-                case EvalCommand(_, _):
-                    resp = self.eval(cmd)
-                case CostCommand(_):
-                    resp = self.cost(cmd)
-                case CommitCommand(_):
-                    resp = self.commit(cmd)
+        """Converse until the agent commits or the budget runs out.
+
+        Return the best program and the number of rounds. Afterward,
+        `stop_reason` says why the conversation ended, and the chat is
+        closed. If learned rules alone reach the goal, no conversation is
+        needed.
+        """
+        try:
+            return await self._run()
+        finally:
+            self.close()
+
+    async def _run(self) -> tuple[lang.Program, int]:
+        session_start = time.perf_counter()
+        with trace.tracing() as session_trace:
+            await self.seed()
+            if (reason := self.over_budget(session_start, 0)) in (
+                "optimal",
+                "target",
+            ):
+                assert self.best_prog
+                self.stop_reason = reason
+                return self.best_prog, 0
+
+            self.system(self.prompt("opt_agent.md"))
+            cmds = await self.get_commands("Enter your first command:")
+
+            while True:
+                round = self.rounds
+                self.rounds += 1
+                start = time.perf_counter()
+                error = None
+                with trace.tracing() as round_trace:
+                    if len(cmds) == 1:
+                        cmd = cmds[0]
+                        LOG.info("%i. %s", round + 1, cmd.log())
+                        resp = await self.execute(cmd)
+                        command = cmd.log().replace("\n", ", ")
+                        summary = f"{command}: {self.outcome}"
+                    else:
+                        resp, summary = await self.execute_batch(round, cmds)
+
                     if resp is None:
-                        break
-                case _:
-                    assert_never(cmd)
+                        self.stop_reason = "committed"
+                    elif reason := self.over_budget(
+                        session_start, session_trace.counters["tokens"]
+                    ):
+                        self.stop_reason = reason
+                    else:
+                        self.summaries[len(self.history) - 1] = summary
+                        prompt = self.prompt("next_command.md")
+                        try:
+                            cmds = await self.get_commands(
+                                f"{resp}\n\n{prompt}"
+                            )
+                        except AskError as e:
+                            error = e
+                self.asker.log_trace(
+                    round_trace,
+                    start,
+                    kind="opt",
+                    session=self.session,
+                    round=round + 1,
+                    summary=summary,
+                )
 
-            prompt = self.prompt("next_command.md")
-            try:
-                cmd = await self.get_command(f"{resp}\n\n{prompt}")
-            except AskError:
-                if self.best_prog:
-                    return self.best_prog, round + 1
-                raise
+                if error and not self.best_prog:
+                    raise error
+                if error or self.stop_reason:
+                    break
 
-        LOG.debug("Ended after %d interaction rounds.", round + 1)
+        LOG.debug(
+            "Ended after %d interaction rounds (%s).",
+            self.rounds,
+            self.stop_reason,
+        )
         if self.best_prog:
-            return self.best_prog, round + 1
-        raise AskError(f"no equivalent found after {MAX_ROUNDS} rounds")
+            await self.asker.learn(self.prog, self.best_prog)
+            return self.best_prog, self.rounds
+        raise AskError(
+            f"no equivalent found after {self.rounds} rounds "
+            f"({self.stop_reason})",
+            self.stop_reason,
+        )
 
 
 class Asker:
-    def __init__(self, config: AskConfig):
-        self.client = AsyncClient(host=config.host)
+    def __init__(
+        self,
+        config: AskConfig,
+        verifier: Optional[verify.Verifier] = None,
+        pool: Optional[HostPool] = None,
+    ):
+        self.pool = pool or HostPool(config.hosts or [Endpoint(config.host)])
+        self.verifier = verifier or verify.Verifier()
         self.model = config.model
         self.transcript_dir = config.transcript_dir
+        self.early_stop = config.early_stop
+        self.context_budget = config.context_budget
+        self.samples = config.samples
+        self.budget = config.budget
+        self.corpus_dir = config.corpus_dir
+        self.corpus_size = config.corpus_size
+        self.rules = (
+            rules.RuleStore(config.rules_path) if config.rules_path else None
+        )
+        # Running totals, rather than per-round records, to bound memory.
+        self.responses = 0  # Streamed responses received.
+        self.stopped_early = 0  # Responses cut off once complete.
+        self.trailing_tokens = 0  # Parts received after a complete answer.
+        self.sessions = itertools.count()
+        self.trace_log = (
+            open(config.trace_path, "a") if config.trace_path else None
+        )
+
+        self.replay = config.replay
+        if config.cache_path:
+            self.cache = ResponseCache(config.cache_path, config.cache_size)
+        elif config.replay:
+            raise AskError("replay mode requires a response cache")
+        else:
+            self.cache = None
 
         self.jinja = jinja2.Environment(
             loader=jinja2.PackageLoader("fdpo", "prompts"),
@@ -381,46 +960,289 @@ class Asker:
             }
         )
 
-    def prompt(self, filename: str, **kwargs) -> str:
-        template = self.jinja.get_template(filename)
-        return template.render(**kwargs)
+    def close(self) -> None:
+        """Close the rule store, response cache, and trace log."""
+        if self.rules:
+            self.rules.close()
+        if self.cache:
+            self.cache.close()
+        if self.trace_log:
+            self.trace_log.close()
 
-    async def interact(self, prompt: str):
-        LOG.debug("Sending prompt:\n%s", prompt)
-        resp = await self.client.generate(
-            model=self.model, prompt=prompt, stream=True
-        )
+    def __enter__(self) -> "Asker":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def prompt(self, filename: str, **kwargs) -> str:
+        with trace.span("render"):
+            template = self.jinja.get_template(filename)
+            return template.render(**kwargs)
+
+    def log_trace(self, tr: trace.Trace, start: float, **info: Any) -> None:
+        """Write a JSON-lines record with a trace of some interaction."""
+        if self.trace_log is None:
+            return
+        record = {
+            "model": self.model,
+            **info,
+            "seconds": round(time.perf_counter() - start, 6),
+            **tr.as_dict(),
+        }
+        self.trace_log.write(json.dumps(record) + "\n")
+        self.trace_log.flush()
+
+    async def collect(
+        self,
+        stream: AsyncIterator[Any],
+        get_text: Callable[[Any], str],
+        start: float,
+        complete: Optional[Callable[[str], bool]] = None,
+        transcribe: Optional[Callable[..., None]] = None,
+    ) -> tuple[str, RoundStats]:
+        """Accumulate the text of a streamed response.
+
+        Stop reading (and close the stream, which cancels generation) as soon
+        as `complete` says the text so far contains a complete answer, unless
+        early stopping is disabled. Record statistics for the response.
+        """
         out = []
+        complete_at = None
+        stopped_early = False
+        ttft = None
         LOG.debug("Receiving response.")
-        async for part in resp:  # type: ignore
-            text = part["response"]
+        async for part in stream:
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            text = get_text(part)
             if LOG.level <= logging.DEBUG:
                 print(text, end="", file=sys.stderr, flush=True)
+            if transcribe:
+                transcribe(text, end="")
             out.append(text)
+
+            # Only a closing code fence can complete an answer.
+            if complete and complete_at is None and "`" in text:
+                if complete("".join(out)):
+                    complete_at = len(out)
+                    if self.early_stop:
+                        stopped_early = True
+                        break
+        if stopped_early:
+            await stream.aclose()  # type: ignore
         if LOG.level <= logging.DEBUG:
             print(file=sys.stderr, flush=True)
-        LOG.debug("Response finished with %s parts.", len(out))
-        return "".join(out)
+
+        stats = RoundStats(
+            time.perf_counter() - start,
+            ttft,
+            len(out),
+            complete_at,
+            stopped_early,
+        )
+        self.responses += 1
+        self.stopped_early += stopped_early
+        self.trailing_tokens += stats.trailing
+        trace.record("prefill", ttft or stats.latency)
+        trace.record("generate", stats.latency - (ttft or stats.latency))
+        trace.count("tokens", len(out))
+        # Generation stops unseen, so only reading to the end (with early
+        # stopping disabled) measures the trailing tokens it saves.
+        trace.count("stopped_early", int(stopped_early))
+        trace.count("trailing_tokens", stats.trailing)
+        LOG.debug(
+            "Response finished with %s parts in %.2fs (first after %.2fs)%s.",
+            stats.parts,
+            stats.latency,
+            stats.ttft or 0.0,
+            " (stopped early)" if stopped_early else "",
+        )
+        return "".join(out), stats
+
+    def cache_key(self, endpoint: str, **request: Any) -> str:
+        return cache_key(endpoint=endpoint, model=self.model, **request)
+
+    def cache_get(self, key: str) -> Optional[str]:
+        """Look up a cached response.
+
+        In replay mode, a miss is an error: we never contact the model.
+        """
+        if self.cache is None:
+            return None
+        resp = self.cache.get(key)
+        if resp is None and self.replay:
+            raise AskError("response not found in cache (replay mode)")
+        if resp is not None:
+            LOG.debug("Using cached response.")
+            trace.count("cached")
+        return resp
+
+    def cache_put(self, key: str, resp: str) -> None:
+        if self.cache is not None:
+            self.cache.put(key, resp)
+
+    async def interact(
+        self, prompt: str, complete: Optional[Callable[[str], bool]] = None
+    ) -> str:
+        LOG.debug("Sending prompt:\n%s", prompt)
+        key = self.cache_key("generate", prompt=prompt)
+        if (cached := self.cache_get(key)) is not None:
+            return cached
+
+        start = time.perf_counter()
+        resp = await self.pool.generate(model=self.model, prompt=prompt)
+        out, _ = await self.collect(
+            resp,  # type: ignore
+            lambda part: part["response"],
+            start,
+            complete,
+        )
+        self.cache_put(key, out)
+        return out
 
     async def run(self, prog: lang.Program, inputs: Env) -> Env:
-        input_str = "\n".join(f"{k} = {v}" for k, v in inputs.items())
-        prompt = self.prompt("run.md", prog=prog.pretty(), invals=input_str)
-        res = await self.interact(prompt)
+        start = time.perf_counter()
+        with trace.tracing() as run_trace:
+            input_str = "\n".join(f"{k} = {v}" for k, v in inputs.items())
+            prompt = self.prompt(
+                "run.md", prog=prog.pretty(), invals=input_str
+            )
+            res = await self.interact(prompt)
+        self.log_trace(run_trace, start, kind="run")
         return parse_env_lines(res)
 
-    async def opt(self, prog: lang.Program) -> tuple[lang.Program, int]:
-        return await OptChat(self, prog, self.transcript_dir).run()
+    async def run_batch(
+        self, prog: lang.Program, inputs: list[Env]
+    ) -> list[Env]:
+        """Ask for the outputs for several input vectors in one request.
+
+        Rows missing from the response get empty outputs.
+        """
+        start = time.perf_counter()
+        with trace.tracing() as run_trace:
+            prompt = self.prompt(
+                "run_batch.md",
+                prog=prog.pretty(),
+                inputs=list(prog.inputs),
+                outputs=list(prog.outputs),
+                rows=inputs,
+            )
+            res = await self.interact(prompt)
+        self.log_trace(run_trace, start, kind="run_batch", size=len(inputs))
+        table = parse_table(res)
+        return [table.get(i + 1, {}) for i in range(len(inputs))]
+
+    def apply_rules(self, prog: lang.Program) -> Optional[lang.Program]:
+        """Rewrite a program with learned rules, if any of them help."""
+        if not self.rules:
+            return None
+        with trace.span("rewrite"):
+            found = self.rules.lookup(rules.heads(prog))
+            new_prog, count = rules.rewrite(prog, found)
+        trace.count("rewrites", count)
+        return new_prog if count else None
+
+    async def learn(self, prog: lang.Program, new_prog: lang.Program) -> None:
+        """Learn rewrite rules from a verified optimization."""
+        if not self.rules or cost.score(new_prog) >= cost.score(prog):
+            return
+        with trace.span("mine"):
+            found = await self.verifier.submit(rules.mine, prog, new_prog)
+        for rule in found:
+            if self.rules.add(rule):
+                LOG.info("   learned rule: %s", rule.pretty())
+                trace.count("rules_learned")
+
+    def board(
+        self, prog: lang.Program, target_cost: Optional[int] = None
+    ) -> Board:
+        """Make a board for optimizing a program, with its corpus."""
+        corpus = Corpus(prog, self.corpus_dir, self.corpus_size)
+        return Board(prog, self.verifier, target_cost, corpus)
+
+    async def opt(self, prog: lang.Program) -> tuple[lang.Program, int, str]:
+        """Optimize a program in one agent conversation.
+
+        Return the best program, the number of rounds, and why the
+        conversation stopped. A failed conversation's `AskError` carries its
+        `stop_reason` too.
+        """
+        chat = OptChat(self, prog, self.transcript_dir)
+        new_prog, rounds = await chat.run()
+        return new_prog, rounds, chat.stop_reason
+
+    async def opt_parallel(
+        self, prog: lang.Program, count: int, limit: Optional[int] = None
+    ) -> tuple[lang.Program, int, str]:
+        """Run several agent conversations on one program concurrently.
+
+        At most `limit` conversations are active at once. The agents share a
+        board of verified candidates. Remaining conversations are cancelled
+        once some agent reaches the budget's `target_cost` or after its
+        `seconds`. Return the best program found, the total number of
+        rounds, and why the agents stopped.
+        """
+        board = self.board(prog, self.budget.target_cost)
+        sem = asyncio.Semaphore(limit or count)
+        chats = [
+            OptChat(self, prog, self.transcript_dir, board)
+            for _ in range(count)
+        ]
+
+        async def session(chat: OptChat):
+            async with sem:
+                if board.done.is_set():
+                    return
+                try:
+                    await chat.run()
+                except AskError as e:
+                    LOG.info("   agent failed: %s", e)
+
+        tasks = [asyncio.create_task(session(chat)) for chat in chats]
+        finished = asyncio.gather(*tasks)
+        target = asyncio.create_task(board.done.wait())
+        try:
+            await asyncio.wait(
+                [finished, target],
+                timeout=self.budget.seconds,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if finished.done():
+                finished.result()  # Propagate unexpected errors.
+                reason = "finished"
+            else:
+                reason = "target" if board.done.is_set() else "seconds"
+        finally:
+            for task in tasks + [target]:
+                task.cancel()
+            await asyncio.gather(finished, target, return_exceptions=True)
+
+        rounds = sum(chat.rounds for chat in chats)
+        if board.best_prog:
+            return board.best_prog, rounds, reason
+        raise AskError(f"no equivalent found by {count} agents", reason)
 
     async def opt_oneshot(self, prog: lang.Program) -> lang.Program:
+        start = time.perf_counter()
+        with trace.tracing() as oneshot_trace:
+            try:
+                return await self._opt_oneshot(prog)
+            finally:
+                self.log_trace(oneshot_trace, start, kind="oneshot")
+
+    async def _opt_oneshot(self, prog: lang.Program) -> lang.Program:
         prompt = self.prompt("opt_oneshot.md", prog=prog)
-        res = await self.interact(prompt)
+        res = await self.interact(prompt, prog_complete)
         new_prog = parse_resp_prog(res)
         try:
-            check.check(new_prog)
+            with trace.span("check"):
+                check.check(new_prog)
         except check.CheckError as e:
             raise AskError(f"invalid program: {e}")
-        if ce := smt.equiv(prog, new_prog):
+        if ce := await self.board(prog).equiv(new_prog):
             LOG.debug("counter-example: %s", ce)
             raise AskError("not equivalent")
         else:
+            await self.learn(prog, new_prog)
             return new_prog
@@ -1,13 +1,37 @@
-from . import lang, smt, ask, cost
+from . import lang, ask, cost, verify, mock, trace
+from .hosts import Endpoint, HostPool
+from .store import ResultStore, Key, prog_hash
 from .util import Env
 import random
 import csv
+import gc
+import logging
 import sys
 import os
 import asyncio
-from typing import Optional
-from collections.abc import Generator
-from dataclasses import dataclass
+import heapq
+import time
+import socket
+import multiprocessing
+from functools import partial
+from contextlib import (
+    asynccontextmanager,
+    nullcontext,
+    ExitStack,
+    AbstractAsyncContextManager,
+)
+from typing import Optional, Any
+from collections.abc import (
+    Generator,
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+)
+from dataclasses import dataclass, field
+
+LOG = logging.getLogger("fdpo")
+METHODS = ["oneshot", "agent"]
 
 
 @dataclass(frozen=True)
@@ -17,6 +41,27 @@ class BenchConfig:
     transcript_dir: Optional[str]
     count: int
     methods: list[str]
+    workers: Optional[int] = None
+    limit: Optional[int] = None
+    model_limit: Optional[int] = None
+    cache_path: Optional[str] = None
+    cache_size: Optional[int] = None
+    replay: bool = False
+    seed: Optional[int] = None
+    samples: int = 1
+    trace_path: Optional[str] = None
+    store_path: Optional[str] = None
+    batch: int = 1  # Test vectors per `bench-run` request.
+    corpus_dir: Optional[str] = None
+    corpus_size: int = 64
+    rules_path: Optional[str] = None
+    budget: ask.Budget = ask.Budget()
+    hosts: tuple[Endpoint, ...] = ()  # Balance requests across these.
+    solvers: Optional[int] = None  # Use a pool of this many z3 processes.
+    solver_timeout: Optional[float] = None
+    recycle: Optional[int] = None  # Replace worker processes this often.
+    early_stop: bool = True
+    context_budget: Optional[int] = None
 
     def ask_configs(self) -> Generator[ask.AskConfig, None, None]:
         for model in self.models:
@@ -24,95 +69,534 @@ class BenchConfig:
                 host=self.host,
                 model=model,
                 transcript_dir=self.transcript_dir,
+                early_stop=self.early_stop,
+                context_budget=self.context_budget,
+                cache_path=self.cache_path,
+                cache_size=self.cache_size,
+                replay=self.replay,
+                samples=self.samples,
+                trace_path=self.trace_path,
+                budget=self.budget,
+                corpus_dir=self.corpus_dir,
+                corpus_size=self.corpus_size,
+                rules_path=self.rules_path,
+                hosts=self.hosts,
             )
 
+    async def host_pool(self) -> HostPool:
+        """Make a pool of model hosts for all models to share."""
+        pool = HostPool(self.hosts or [Endpoint(self.host)])
+        if not self.replay:
+            await pool.check()
+        return pool
+
 
-def gen_inputs(ports: list[lang.Port]) -> Env:
-    return {port.name: random.getrandbits(port.width) for port in ports}
+def gen_inputs(ports: list[lang.Port], rng: random.Random) -> Env:
+    return {port.name: rng.getrandbits(port.width) for port in ports}
 
 
-async def bench_run_exp(prog: lang.Program, asker: ask.Asker) -> bool:
-    # Generate a test vector, and get the golden output.
-    inputs = gen_inputs(list(prog.inputs.values()))
-    outputs = smt.run(prog, inputs)
+async def bench_run_exp(
+    prog: lang.Program, asker: ask.Asker, inputs: list[Env], tr: trace.Trace
+) -> tuple[int, float]:
+    """Ask to run a program on a batch of test vectors.
 
-    # "Ask" to run the same program.
-    test_outputs = await asker.run(prog, inputs)
+    Return the number of correct outputs and the elapsed seconds.
+    """
+    start = time.perf_counter()
+    with trace.tracing(tr):
+        if len(inputs) == 1:
+            # Get the golden output for the test vector.
+            outputs = [await asker.verifier.run(prog, inputs[0])]
 
-    return outputs == test_outputs
+            # "Ask" to run the same program.
+            test_outputs = [await asker.run(prog, inputs[0])]
+        else:
+            outputs = await asker.verifier.run_many(prog, inputs)
+            test_outputs = await asker.run_batch(prog, inputs)
 
+    matches = sum(out == test for out, test in zip(outputs, test_outputs))
+    return matches, time.perf_counter() - start
 
-async def bench_run_one(filename: str, asker: ask.Asker, count: int) -> int:
+
+def read_prog(filename: str) -> lang.Program:
     with open(filename) as f:
         src = f.read()
     prog, _ = lang.parse(src)
+    return prog
+
+
+def prog_name(filename: str) -> str:
+    name, _ = os.path.splitext(os.path.basename(filename))
+    return name
+
+
+@dataclass(order=True)
+class Task:
+    """A unit of benchmark work, ordered so the longest tasks come first."""
+
+    priority: float
+    id: int
+    model: str = field(compare=False)
+    func: Callable[[], Awaitable[Any]] = field(compare=False)
+
+
+class Scheduler:
+    """Run benchmark tasks concurrently under global and per-model limits.
+
+    Tasks are started in priority order, with the longest expected tasks
+    first, and results are reported in completion order. A limit of None
+    means unbounded.
+    """
+
+    def __init__(
+        self, limit: Optional[int] = None, model_limit: Optional[int] = None
+    ):
+        self.limit = limit
+        self.model_limit = model_limit
+        self.heap: list[Task] = []
+        self.next_id = 0
+
+    def add(
+        self, func: Callable[[], Awaitable[Any]], model: str, cost: float
+    ) -> int:
+        """Enqueue a task with an estimated relative cost, returning its id.
+
+        Ids are assigned sequentially, so they are stable across runs with
+        the same configuration.
+        """
+        task_id = self.next_id
+        self.next_id += 1
+        heapq.heappush(self.heap, Task(-cost, task_id, model, func))
+        return task_id
 
-    score = 0
-    tasks = [bench_run_exp(prog, asker) for _ in range(count)]
-    for task in asyncio.as_completed(tasks):
-        # Score one when we match.
-        score += await task
+    @staticmethod
+    def _sem(limit: Optional[int]) -> AbstractAsyncContextManager:
+        return asyncio.Semaphore(limit) if limit else nullcontext()
 
-    return score
+    async def run(self) -> AsyncGenerator[tuple[int, Any], None]:
+        """Run all enqueued tasks, yielding (id, result) as they finish."""
+        global_sem = self._sem(self.limit)
+        model_sems = {}
+
+        async def run_task(task: Task) -> tuple[int, Any]:
+            if task.model not in model_sems:
+                model_sems[task.model] = self._sem(self.model_limit)
+            # Semaphores wake waiters in FIFO order, so tasks start in the
+            # order they are created here: by priority.
+            async with model_sems[task.model]:
+                async with global_sem:
+                    return task.id, await task.func()
+
+        running = []
+        while self.heap:
+            task = heapq.heappop(self.heap)
+            running.append(asyncio.create_task(run_task(task)))
+        try:
+            for fut in asyncio.as_completed(running):
+                yield await fut
+        finally:
+            for fut in running:
+                fut.cancel()
+
+
+def scheduler(config: BenchConfig) -> Scheduler:
+    return Scheduler(config.limit, config.model_limit)
 
 
 async def bench_run(filenames: list[str], config: BenchConfig):
     writer = csv.writer(sys.stdout)
-    writer.writerow(["prog", "model", "successes"])
+    writer.writerow(
+        ["id", "prog", "model", "successes", "batch", "seconds"]
+        + ["early_stop", "context_budget", "stopped_early", "trailing_tokens"]
+        + [f"{phase}_s" for phase in trace.PHASES]
+    )
     sys.stdout.flush()
-    for ask_config in config.ask_configs():
-        asker = ask.Asker(ask_config)
-        tasks = {
-            filename: bench_run_one(filename, asker, config.count)
-            for filename in filenames
-        }
-        for filename, task in tasks.items():
-            successes = await task
-            name, _ = os.path.splitext(os.path.basename(filename))
-            writer.writerow([name, ask_config.model, successes])
-            sys.stdout.flush()
+    pool = await config.host_pool()
+    with (
+        verify.Verifier(
+            config.workers,
+            solvers=config.solvers,
+            solver_timeout=config.solver_timeout,
+            recycle=config.recycle,
+        ) as verifier,
+        ExitStack() as askers,
+    ):
+        sched = scheduler(config)
+        rng = random.Random(config.seed)
 
+        # Each batch of test vectors is a separate task. Rows report the
+        # total for each (program, model) group when its last batch finishes.
+        groups: list[tuple[str, str]] = []
+        group_of: dict[int, int] = {}
+        traces: list[trace.Trace] = []
+        remaining: list[int] = []
+        for ask_config in config.ask_configs():
+            asker = askers.enter_context(ask.Asker(ask_config, verifier, pool))
+            for filename in filenames:
+                prog = read_prog(filename)
+                group_trace = trace.Trace()
 
-def bench_opt_tasks(
-    filenames: list[str], config: BenchConfig, asker: ask.Asker
-):
-    for filename in filenames:
-        with open(filename) as f:
-            src = f.read()
-        prog, _ = lang.parse(src)
+                # Generate test vectors up front so that a seeded run is
+                # deterministic (and so replayable from a cache).
+                vectors = [
+                    gen_inputs(list(prog.inputs.values()), rng)
+                    for _ in range(config.count)
+                ]
+                tasks = 0
+                for i in range(0, len(vectors), config.batch):
+                    batch = vectors[i : i + config.batch]
+                    task_id = sched.add(
+                        partial(
+                            bench_run_exp, prog, asker, batch, group_trace
+                        ),
+                        ask_config.model,
+                        len(prog.assignments) * len(batch),
+                    )
+                    group_of[task_id] = len(groups)
+                    tasks += 1
+                groups.append((prog_name(filename), ask_config.model))
+                traces.append(group_trace)
+                remaining.append(tasks)
+
+        successes = [0] * len(groups)
+        seconds = [0.0] * len(groups)
+        async for task_id, (matches, secs) in sched.run():
+            group_id = group_of[task_id]
+            successes[group_id] += matches  # Score one for each match.
+            seconds[group_id] += secs
+            remaining[group_id] -= 1
+            if remaining[group_id] == 0:
+                name, model = groups[group_id]
+                writer.writerow(
+                    [
+                        group_id,
+                        name,
+                        model,
+                        successes[group_id],
+                        config.batch,
+                        f"{seconds[group_id]:.2f}",
+                        config.early_stop,
+                        config.context_budget or "",
+                        traces[group_id].counters["stopped_early"],
+                        traces[group_id].counters["trailing_tokens"],
+                    ]
+                    + traces[group_id].columns()
+                )
+                sys.stdout.flush()
+    pool.log_metrics()
 
-        # One-shot queries.
-        if "oneshot" in config.methods:
-            for _ in range(config.count):
-                yield filename, "oneshot", asker.opt_oneshot(prog)
 
-        # Agent queries.
-        if "agent" in config.methods:
-            for _ in range(config.count):
-                yield filename, "agent", asker.opt(prog)
+async def bench_opt_one(
+    prog: lang.Program, method: str, asker: ask.Asker
+) -> tuple[int, int, float, trace.Trace, str]:
+    """Optimize a program with one method.
+
+    Return the cost, the number of rounds, the elapsed seconds, a trace, and
+    why the optimization stopped.
+    """
+    start = time.perf_counter()
+    with trace.tracing() as tr:
+        try:
+            if method == "oneshot":
+                new_prog = await asker.opt_oneshot(prog)
+                rounds = 1
+                reason = "oneshot"
+            else:
+                new_prog, rounds, reason = await asker.opt(prog)
+        except ask.AskError as e:
+            return -1, -1, time.perf_counter() - start, tr, e.stop_reason
+    secs = time.perf_counter() - start
+    return cost.score(new_prog), rounds, secs, tr, reason
 
 
 async def bench_opt(filenames: list[str], config: BenchConfig):
     writer = csv.writer(sys.stdout)
-    writer.writerow(["prog", "method", "model", "best_cost", "rounds"])
+    writer.writerow(
+        ["id", "prog", "method", "model", "best_cost", "rounds", "seconds"]
+        + ["stop_reason", "wrong", "corpus_caught"]
+        + ["early_stop", "context_budget", "stopped_early", "trailing_tokens"]
+        + [f"{phase}_s" for phase in trace.PHASES]
+    )
     sys.stdout.flush()
-    for ask_config in config.ask_configs():
-        asker = ask.Asker(ask_config)
-        for filename, method, task in bench_opt_tasks(
-            filenames, config, asker
+    pool = await config.host_pool()
+    with (
+        verify.Verifier(
+            config.workers,
+            solvers=config.solvers,
+            solver_timeout=config.solver_timeout,
+            recycle=config.recycle,
+        ) as verifier,
+        ResultStore(config.store_path)
+        if config.store_path
+        else nullcontext() as results,
+        ExitStack() as askers,
+    ):
+        sched = scheduler(config)
+
+        async def task(
+            prog: lang.Program,
+            name: str,
+            method: str,
+            asker: ask.Asker,
+            key: Key,
         ):
-            try:
-                # TODO: Super hacky; make this type safe.
-                if method == "oneshot":
-                    new_prog = await task
-                    rounds = 1
-                else:
-                    new_prog, rounds = await task  # type: ignore
-            except ask.AskError as e:
-                score = -1
-                rounds = -1
-            else:
-                score = cost.score(new_prog)  # type: ignore
-            name, _ = os.path.splitext(os.path.basename(filename))
-            writer.writerow([name, method, ask_config.model, score, rounds])
+            # Skip tasks that are already done (or running elsewhere).
+            if results and not results.claim(key, name):
+                return None
+            res = await bench_opt_one(prog, method, asker)
+            if results:
+                results.put(key, *res[:3])
+            return res
+
+        rows = {}
+        for ask_config in config.ask_configs():
+            asker = askers.enter_context(ask.Asker(ask_config, verifier, pool))
+            for filename in filenames:
+                prog = read_prog(filename)
+                for method in METHODS:
+                    if method not in config.methods:
+                        continue
+                    # Agent conversations take many rounds, one-shot just one.
+                    estimate = len(prog.assignments) * (
+                        config.budget.rounds if method == "agent" else 1
+                    )
+                    for rep in range(config.count):
+                        key = Key(
+                            prog_hash(prog), ask_config.model, method, rep
+                        )
+                        task_id = sched.add(
+                            partial(
+                                task,
+                                prog,
+                                prog_name(filename),
+                                method,
+                                asker,
+                                key,
+                            ),
+                            ask_config.model,
+                            estimate,
+                        )
+                        rows[task_id] = [
+                            prog_name(filename),
+                            method,
+                            ask_config.model,
+                        ]
+
+        async for task_id, res in sched.run():
+            if res is None:
+                continue
+            score, rounds, secs, tr, reason = res
+            writer.writerow(
+                [task_id]
+                + rows[task_id]
+                + [score, rounds, f"{secs:.2f}", reason]
+                + [tr.counters["wrong"], tr.counters["corpus_caught"]]
+                + [config.early_stop, config.context_budget or ""]
+                + [
+                    tr.counters["stopped_early"],
+                    tr.counters["trailing_tokens"],
+                ]
+                + tr.columns()
+            )
             sys.stdout.flush()
+    pool.log_metrics()
+
+
+def run_mock(config: mock.MockConfig, port: int) -> None:
+    asyncio.run(mock.serve(config, "127.0.0.1", port))
+
+
+async def loop_lag(interval: float, lags: list[float]) -> None:
+    """Record how late the event loop wakes up from each short sleep."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def bench_harness_one(
+    prog: lang.Program, pool: HostPool, agents: int, verifier: verify.Verifier
+) -> list:
+    """Run concurrent agents against mock servers and measure throughput."""
+    with ask.Asker(
+        ask.AskConfig(
+            host=pool.hosts[0].endpoint.url, model="mock", transcript_dir=None
+        ),
+        verifier,
+        pool,
+    ) as asker:
+        lags = []
+        monitor = asyncio.create_task(loop_lag(0.005, lags))
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(asker.opt(prog) for _ in range(agents)), return_exceptions=True
+        )
+        elapsed = time.perf_counter() - start
+        monitor.cancel()
+
+    # A "stall" is any time the loop is more than 50 ms late.
+    stalls = [lag for lag in lags if lag > 0.05]
+    return [
+        agents,
+        asker.responses,
+        f"{elapsed:.2f}",
+        f"{asker.responses / elapsed:.1f}",
+        f"{max(lags, default=0) * 1000:.1f}",
+        len(stalls),
+        f"{sum(stalls) * 1000:.1f}",
+        asker.stopped_early,
+        asker.trailing_tokens,
+    ]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def mock_servers(
+    config: mock.MockConfig, count: int = 1
+) -> AsyncIterator[list[Endpoint]]:
+    """Start mock model servers and wait for them to listen.
+
+    The servers run in separate processes so that they do not compete with
+    the harness for the event loop.
+    """
+    ports = [free_port() for _ in range(count)]
+    servers = [
+        multiprocessing.Process(
+            target=run_mock, args=(config, port), daemon=True
+        )
+        for port in ports
+    ]
+    for server in servers:
+        server.start()
+    try:
+        for port in ports:
+            while True:
+                try:
+                    _, w = await asyncio.open_connection("127.0.0.1", port)
+                    w.close()
+                    break
+                except ConnectionError:
+                    await asyncio.sleep(0.05)
+        yield [Endpoint(f"http://127.0.0.1:{port}") for port in ports]
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+async def bench_harness(
+    filename: str,
+    counts: list[int],
+    config: mock.MockConfig,
+    hosts: int = 1,
+    dead: int = 0,
+):
+    """Measure harness overhead using mock model servers.
+
+    Requests are balanced across `hosts` servers, plus `dead` endpoints
+    where nothing listens, to exercise failover.
+    """
+    prog = read_prog(filename)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(
+        [
+            "agents",
+            "rounds",
+            "seconds",
+            "rounds_per_sec",
+            "max_lag_ms",
+            "stalls",
+            "stall_ms",
+            "stopped_early",
+            "trailing_tokens",
+        ]
+    )
+    async with mock_servers(config, hosts) as live:
+        pool = HostPool(
+            live
+            + [
+                Endpoint(f"http://127.0.0.1:{free_port()}")
+                for _ in range(dead)
+            ]
+        )
+        await pool.check()
+        with verify.Verifier() as verifier:
+            for agents in counts:
+                row = await bench_harness_one(prog, pool, agents, verifier)
+                writer.writerow(row)
+                sys.stdout.flush()
+        pool.log_metrics()
+
+
+async def bench_soak(
+    filename: str,
+    sessions: int,
+    config: mock.MockConfig,
+    concurrency: int = 10,
+    every: int = 100,
+    rounds: int = 3,
+    solvers: Optional[int] = None,
+    recycle: Optional[int] = None,
+    transcript_dir: Optional[str] = None,
+):
+    """Run many short agent sessions against a mock server, watching memory.
+
+    After every `every` sessions, write the process's gauges (see
+    `trace.gauges`). Once caches fill up, they should stay flat.
+    """
+    prog = read_prog(filename)
+    writer = csv.writer(sys.stdout)
+    columns = ["rss_kb", "objects", "blocks", "fds"]
+    writer.writerow(["sessions", "seconds"] + columns)
+    started = finished = 0
+    start = time.perf_counter()
+    rows = []
+
+    async def worker(asker: ask.Asker) -> None:
+        nonlocal started, finished
+        while started < sessions:
+            started += 1
+            try:
+                await asker.opt(prog)
+            except ask.AskError:
+                pass
+            finished += 1
+            if finished % every == 0:
+                gc.collect()
+                gauges = trace.gauges()
+                rows.append(gauges)
+                writer.writerow(
+                    [finished, f"{time.perf_counter() - start:.2f}"]
+                    + [gauges.get(k, "") for k in columns]
+                )
+                sys.stdout.flush()
+
+    async with mock_servers(config) as live:
+        with verify.Verifier(solvers=solvers, recycle=recycle) as verifier:
+            with ask.Asker(
+                ask.AskConfig(
+                    host=live[0].url,
+                    model="mock",
+                    transcript_dir=transcript_dir,
+                    budget=ask.Budget(rounds=rounds),
+                ),
+                verifier,
+                HostPool(live),
+            ) as asker:
+                await asyncio.gather(
+                    *(worker(asker) for _ in range(concurrency))
+                )
+
+    # Compare the second half of the run to the first, after warming up.
+    if len(rows) >= 4:
+        mid, last = rows[len(rows) // 2], rows[-1]
+        LOG.info(
+            "second half: rss %+i KiB, objects %+i, blocks %+i",
+            last["rss_kb"] - mid["rss_kb"],
+            last["objects"] - mid["objects"],
+            last["blocks"] - mid["blocks"],
+        )
@@ -0,0 +1,85 @@
+import sqlite3
+import hashlib
+import json
+import time
+import os
+from typing import Optional, Any
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+"""
+
+
+def cache_key(**kwargs: Any) -> str:
+    """Get a content hash for a request, given all of its parameters."""
+    data = json.dumps(kwargs, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class ResponseCache:
+    """An on-disk cache of model responses in an SQLite database.
+
+    Entries are keyed by a hash of the entire request. When the total size
+    of the stored responses exceeds `max_bytes`, the least recently used
+    entries are evicted.
+    """
+
+    def __init__(self, path: str, max_bytes: Optional[int] = None):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.db.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.db:
+            self.db.execute(
+                "UPDATE responses SET used = ? WHERE key = ?",
+                (time.time(), key),
+            )
+        return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, response, len(response.encode()), time.time()),
+            )
+            if self.max_bytes is not None:
+                self._evict(self.max_bytes)
+
+    def _evict(self, max_bytes: int) -> None:
+        (total,) = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if total <= max_bytes:
+            return
+        rows = self.db.execute(
+            "SELECT key, size FROM responses ORDER BY used"
+        ).fetchall()
+        doomed = []
+        for key, size in rows:
+            if total <= max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def close(self) -> None:
+        self.db.close()
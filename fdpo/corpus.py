@@ -0,0 +1,115 @@
+from . import lang, interp
+from .smt import Counterexample
+from .store import prog_hash
+from .util import Env
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Optional
+
+LOG = logging.getLogger("fdpo")
+
+
+class Corpus:
+    """Inputs that distinguished some wrong candidate from a program.
+
+    Each new candidate is first run on these inputs with the concrete
+    interpreter, which is much cheaper than a solver call and catches most
+    wrong candidates, since they tend to make the same mistakes. At most
+    `capacity` inputs are kept, evicting those that least recently caught a
+    candidate. With a `directory`, the corpus is loaded from and saved to a
+    file named for the program's hash, so it carries over between sessions.
+    """
+
+    def __init__(
+        self,
+        prog: lang.Program,
+        directory: Optional[str] = None,
+        capacity: int = 64,
+    ):
+        self.prog = prog
+        self.capacity = capacity
+        self.path = (
+            os.path.join(directory, f"{prog_hash(prog)}.jsonl")
+            if directory
+            else None
+        )
+        # Map each input (as a sorted tuple) to the program's outputs.
+        self.entries: OrderedDict[tuple, Env] = OrderedDict()
+        self.caught = 0  # Wrong candidates caught by the corpus.
+        self.missed = 0  # Wrong candidates that needed the solver.
+
+        try:
+            interp.schedule(prog)
+            self.enabled = True
+        except interp.CycleError:
+            LOG.debug("not using a corpus for a cyclic program")
+            self.enabled = False
+        if self.path and self.enabled:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def load(self) -> None:
+        assert self.path
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    self.insert(json.loads(line))
+        except FileNotFoundError:
+            pass
+
+    def save(self) -> None:
+        """Write the corpus, atomically, in least to most useful order."""
+        assert self.path
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            for key in self.entries:
+                f.write(json.dumps(dict(key)) + "\n")
+        os.replace(tmp, self.path)
+
+    def insert(self, inputs: Env) -> None:
+        key = tuple(sorted(inputs.items()))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = interp.interp(self.prog, inputs)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def add(self, inputs: Env) -> None:
+        """Add the inputs of a counterexample that the solver found."""
+        if not self.enabled or set(inputs) != set(self.prog.inputs):
+            return
+        self.missed += 1
+        self.insert(inputs)
+        if self.path:
+            self.save()
+
+    def check(self, prog: lang.Program) -> Optional[Counterexample]:
+        """Look for a corpus input that distinguishes a candidate."""
+        if not self.enabled:
+            return None
+        for key, expected in self.entries.items():
+            try:
+                actual = interp.interp(prog, dict(key))
+            except interp.CycleError:
+                return None
+            differing = {
+                name: (value, actual[name])
+                for name, value in expected.items()
+                if actual[name] != value
+            }
+            if differing:
+                self.entries.move_to_end(key)
+                self.caught += 1
+                return Counterexample(dict(key), differing)
+        return None
+
+    def catch_rate(self) -> Optional[float]:
+        """The fraction of wrong candidates that the corpus caught."""
+        total = self.caught + self.missed
+        return self.caught / total if total else None
@@ -1,6 +1,14 @@
 from . import lang, lib
+import functools
 
+# Memoize scores for subexpressions and whole programs. Expressions and
+# programs carry cached structural hashes, so a candidate that differs from a
+# previously scored one in a single assignment only needs to score the
+# changed expression.
+CACHE_SIZE = 1 << 16
 
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
 def score_expr(expr: lang.Expression) -> int:
     match expr:
         case lang.Call(fname, params, inputs):
@@ -10,5 +18,6 @@ def score_expr(expr: lang.Expression) -> int:
             return 0
 
 
+@functools.lru_cache(maxsize=CACHE_SIZE // 16)
 def score(prog: lang.Program) -> int:
     return sum(score_expr(a.expr) for a in prog.assignments)
@@ -0,0 +1,74 @@
+from . import lang
+from .interp import CycleError, schedule, uses
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class Region:
+    """The part of a program that a new version changed.
+
+    Each side is a small program whose inputs are the boundary signals the
+    changed assignments read and whose outputs are the signals the rest of
+    the program (or the outside world) reads from them. If the two sides are
+    equivalent, so are the whole (acyclic) programs, since everything outside
+    the region is identical.
+    """
+
+    old: lang.Program
+    new: lang.Program
+
+    def size(self) -> int:
+        return len(self.old.assignments) + len(self.new.assignments)
+
+
+def widths(prog: lang.Program) -> dict[str, int]:
+    ports = prog.inputs | prog.outputs | prog.temps
+    return {name: port.width for name, port in ports.items()}
+
+
+def region(old: lang.Program, new: lang.Program) -> Optional[Region]:
+    """Find the changed region between two checked programs.
+
+    Return None if the programs cannot be compared locally.
+    """
+    if old.inputs != new.inputs or old.outputs != new.outputs:
+        return None
+    try:
+        schedule(old)
+        schedule(new)
+    except CycleError:
+        return None
+
+    old_set = set(old.assignments)
+    new_set = set(new.assignments)
+    old_only = [a for a in old.assignments if a not in new_set]
+    new_only = [a for a in new.assignments if a not in old_set]
+    old_defs = {a.dest for a in old_only}
+    new_defs = {a.dest for a in new_only}
+    defs = old_defs | new_defs
+
+    # Signals flowing into and out of the region.
+    reads = {var for a in old_only + new_only for var in uses(a.expr)}
+    escape = set(new.outputs).union(
+        *(uses(a.expr) for a in new.assignments if a in old_set)
+    )
+    old_widths = widths(old)
+    new_widths = widths(new)
+    inputs = {}
+    for name in sorted(reads - defs):
+        if name not in old_widths or old_widths[name] != new_widths.get(name):
+            return None
+        inputs[name] = lang.Port(name, old_widths[name])
+    outputs = {}
+    for name in sorted(defs & escape):
+        if name not in old_defs or name not in new_defs:
+            return None
+        if old_widths[name] != new_widths[name]:
+            return None
+        outputs[name] = lang.Port(name, old_widths[name])
+
+    return Region(
+        lang.Program(inputs, outputs, old_only),
+        lang.Program(inputs, outputs, new_only),
+    )
@@ -0,0 +1,211 @@
+from . import lang, lib
+import random
+from collections import deque
+from collections.abc import Iterator
+from dataclasses import dataclass
+from typing import Optional, TextIO
+
+COMMUTATIVE = {"add", "mul", "and", "or", "xor"}
+
+
+@dataclass(frozen=True)
+class GenConfig:
+    size: int = 100  # Number of assignments.
+    inputs: int = 4
+    outputs: int = 1
+    widths: tuple[int, ...] = (8, 16, 32)
+    window: int = 16  # How many recent values may be used as operands.
+    max_depth: Optional[int] = None  # Longest path from an input.
+    max_fanout: Optional[int] = None  # Most uses of any temporary.
+    literals: float = 0.05  # Probability that an operand is a literal.
+    ops: Optional[dict[str, float]] = None  # Relative operator weights.
+    seed: int = 0
+
+
+@dataclass
+class Value:
+    name: str
+    width: int
+    depth: int
+    uses: int = 0
+
+
+class Generator:
+    """Generate a random, well-formed program one assignment at a time.
+
+    Operands are drawn from the inputs and the last `window` temporaries,
+    so memory use does not depend on the size of the program. A small
+    window makes long, narrow dependency chains; a large one makes wide,
+    shallow programs. Operands of the wrong width are sliced or extended.
+    """
+
+    def __init__(self, config: GenConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        ops = config.ops or {name: 1.0 for name in lib.FUNCTIONS}
+        for name in ops:
+            if name not in lib.FUNCTIONS:
+                raise ValueError(f"unknown function {name}")
+        self.ops = list(ops)
+        self.weights = list(ops.values())
+        self.inputs = [
+            Value(f"in{i}", self.rng.choice(config.widths), 0)
+            for i in range(config.inputs)
+        ]
+        self.outputs = [
+            lang.Port(f"out{i}", self.rng.choice(config.widths))
+            for i in range(config.outputs)
+        ]
+        self.window: deque[Value] = deque(maxlen=config.window)
+
+    def usable(self, value: Value) -> bool:
+        config = self.config
+        if config.max_depth is not None and value.depth >= config.max_depth:
+            return False
+        if config.max_fanout is not None and value.uses >= config.max_fanout:
+            return False
+        return True
+
+    def operand(
+        self, width: int, avoid: Optional[lang.Expression] = None
+    ) -> tuple[lang.Expression, int]:
+        """Pick an operand of a given width, returning it and its depth.
+
+        Prefer an operand other than `avoid`, so that binary operations do
+        not degenerate into `x op x`.
+        """
+        if self.rng.random() < self.config.literals:
+            value = self.rng.getrandbits(width)
+            return lang.Literal(width, 10, value), 0
+
+        pool = [v for v in self.window if self.usable(v)] + self.inputs
+        matching = [v for v in pool if v.width == width] or pool
+        exprs = {
+            v.name: convert(lang.Lookup(v.name), v.width, width)
+            for v in matching
+        }
+        value = self.rng.choice(
+            [v for v in matching if exprs[v.name] != avoid] or matching
+        )
+        value.uses += 1
+        return exprs[value.name], value.depth
+
+    def pair(self, width: int) -> list[tuple[lang.Expression, int]]:
+        """Pick two (preferably different) operands of a given width."""
+        first = self.operand(width)
+        return [first, self.operand(width, first[0])]
+
+    def call(self, width: int) -> tuple[lang.Expression, int]:
+        """Generate a call that produces a value of a given width."""
+        func = self.rng.choices(self.ops, self.weights)[0]
+        match func:
+            case "gt" | "lt":
+                # Comparisons produce one bit; convert it to the width.
+                in_width = self.rng.choice(self.config.widths)
+                args = self.pair(in_width)
+                expr = convert(
+                    lang.Call(func, [in_width], [a for a, _ in args]), 1, width
+                )
+            case "if":
+                args = [self.operand(1)] + self.pair(width)
+                expr = lang.Call(func, [width], [a for a, _ in args])
+            case "sext" | "zext":
+                narrower = [w for w in self.config.widths if w < width]
+                in_width = self.rng.choice(narrower or [width])
+                args = [self.operand(in_width)]
+                expr = lang.Call(func, [in_width, width], [a for a, _ in args])
+            case "slice":
+                wider = [w for w in self.config.widths if w >= width]
+                in_width = self.rng.choice(wider or [width])
+                lo = self.rng.randint(0, in_width - width)
+                args = [self.operand(in_width)]
+                expr = lang.Call(
+                    func, [in_width, lo, lo + width - 1], [a for a, _ in args]
+                )
+            case _:
+                args = self.pair(width)
+                expr = lang.Call(func, [width], [a for a, _ in args])
+        return expr, 1 + max(depth for _, depth in args)
+
+    def assignments(self) -> Iterator[lang.Assignment]:
+        """Generate all the program's assignments, ending with the outputs."""
+        for i in range(self.config.size):
+            width = self.rng.choice(self.config.widths)
+            expr, depth = self.call(width)
+            value = Value(f"t{i}", width, depth)
+            self.window.append(value)
+            yield lang.Assignment(value.name, width, expr)
+
+        # Outputs take the most recent values, in reverse order.
+        recent = list(self.window)[::-1] or self.inputs
+        for i, port in enumerate(self.outputs):
+            value = recent[i % len(recent)]
+            expr = convert(lang.Lookup(value.name), value.width, port.width)
+            yield lang.Assignment(port.name, None, expr)
+
+    def decls(self) -> Iterator[str]:
+        for value in self.inputs:
+            yield lang.Port(value.name, value.width).pretty(lang.Direction.IN)
+        for port in self.outputs:
+            yield port.pretty(lang.Direction.OUT)
+
+
+def convert(expr: lang.Expression, width: int, to: int) -> lang.Expression:
+    """Slice or zero-extend an expression to another width."""
+    if width < to:
+        return lang.Call("zext", [width, to], [expr])
+    elif width > to:
+        return lang.Call("slice", [width, 0, to - 1], [expr])
+    return expr
+
+
+def rewrite(asgt: lang.Assignment, rng: random.Random) -> lang.Assignment:
+    """Rewrite an assignment into an equivalent one (or leave it alone)."""
+    expr = asgt.expr
+    if not isinstance(expr, lang.Call) or rng.random() < 0.5:
+        return asgt
+    if expr.func in COMMUTATIVE:
+        new = lang.Call(expr.func, expr.params, expr.inputs[::-1])
+    elif expr.func == "sub":
+        # x - y == x + (0 - y)
+        width = expr.params[0]
+        x, y = expr.inputs
+        zero = lang.Literal(width, 10, 0)
+        neg = lang.Call("sub", [width], [zero, y])
+        new = lang.Call("add", [width], [x, neg])
+    else:
+        return asgt
+    return lang.Assignment(asgt.dest, asgt.width, new)
+
+
+def generate(config: GenConfig, variant: bool = False) -> Iterator[str]:
+    """Generate the lines of a random program.
+
+    With `variant`, also generate an equivalent rewritten version of the
+    program after a `---` separator. Both halves are generated from the
+    same seed, so neither one is ever held in memory.
+    """
+    gen = Generator(config)
+    yield from gen.decls()
+    for asgt in gen.assignments():
+        yield asgt.pretty()
+
+    if variant:
+        yield "---"
+        rng = random.Random(config.seed + 1)
+        for asgt in Generator(config).assignments():
+            yield rewrite(asgt, rng).pretty()
+
+
+def write(config: GenConfig, out: TextIO, variant: bool = False) -> None:
+    for line in generate(config, variant):
+        out.write(line)
+        out.write("\n")
+
+
+def gen_program(config: GenConfig) -> lang.Program:
+    """Generate a random program in memory."""
+    gen = Generator(config)
+    inputs = {v.name: lang.Port(v.name, v.width) for v in gen.inputs}
+    outputs = {port.name: port for port in gen.outputs}
+    return lang.Program(inputs, outputs, list(gen.assignments()))
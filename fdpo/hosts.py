@@ -0,0 +1,211 @@
+from ollama import AsyncClient
+from collections.abc import AsyncIterator, Iterable
+from dataclasses import dataclass
+from typing import Any, Optional
+import asyncio
+import httpx
+import logging
+import time
+import weakref
+
+LOG = logging.getLogger("fdpo")
+RETRY_AFTER = 30.0  # Seconds before trying a failed host again.
+
+# Errors that mean we could not talk to a host at all.
+HOST_ERRORS = (ConnectionError, httpx.TransportError)
+
+
+@dataclass(frozen=True)
+class Endpoint:
+    url: str
+    weight: float = 1.0  # Relative share of concurrent requests.
+
+
+class HostError(ConnectionError):
+    pass
+
+
+class Host:
+    """One model server, with its load and throughput statistics."""
+
+    def __init__(self, endpoint: Endpoint):
+        self.endpoint = endpoint
+        self.client = AsyncClient(host=endpoint.url)
+        self.active = 0  # Requests in flight.
+        self.failed = False  # Whether the last request failed to connect.
+        self.down_until = 0.0  # When to try the host again after a failure.
+        self.requests = 0
+        self.failures = 0
+        self.parts = 0  # Streamed response parts (about one token each).
+        self.busy = 0.0  # Seconds with at least one request in flight.
+        self.busy_since = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        """Whether to send a request to the host.
+
+        A failed host is retried one request at a time once it is due.
+        """
+        if not self.failed:
+            return True
+        return self.active == 0 and time.monotonic() >= self.down_until
+
+    def load(self) -> float:
+        return self.active / self.endpoint.weight
+
+    def begin(self) -> None:
+        if self.active == 0:
+            self.busy_since = time.perf_counter()
+        self.active += 1
+        self.requests += 1
+
+    def end(self) -> None:
+        self.active -= 1
+        if self.active == 0:
+            self.busy += time.perf_counter() - self.busy_since
+
+    def fail(self, retry_after: float) -> None:
+        self.failures += 1
+        self.failed = True
+        self.down_until = time.monotonic() + retry_after
+
+    def metrics(self) -> dict[str, Any]:
+        return {
+            "host": self.endpoint.url,
+            "weight": self.endpoint.weight,
+            "healthy": self.healthy,
+            "requests": self.requests,
+            "failures": self.failures,
+            "tokens": self.parts,
+            "busy_s": round(self.busy, 3),
+            "tokens_per_s": round(self.parts / self.busy, 1)
+            if self.busy
+            else 0.0,
+        }
+
+
+class HostPool:
+    """Balance streaming requests across several model servers.
+
+    Each request goes to the healthy host with the fewest requests in flight
+    relative to its weight. A host that refuses a connection (or drops it
+    before sending anything) is marked down for `retry_after` seconds, and
+    the request fails over to the next host. Once some of a response has
+    arrived, though, failures are errors: the response cannot be resumed.
+
+    Requests with the same `affinity` object (like a conversation) stick to
+    the host that answered the first of them, so the server can reuse its
+    prompt cache. They move only when that host fails.
+    """
+
+    def __init__(
+        self, endpoints: Iterable[Endpoint], retry_after: float = RETRY_AFTER
+    ):
+        self.hosts = [Host(e) for e in endpoints]
+        if not self.hosts:
+            raise HostError("no model hosts configured")
+        self.retry_after = retry_after
+        # The host each affinity object is pinned to, forgotten with it.
+        self.pinned: weakref.WeakKeyDictionary[Any, Host] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def candidates(self, affinity: Any = None) -> list[Host]:
+        """Order the hosts to try for a request, best first."""
+        # Break ties by total requests, so even sequential requests spread.
+        healthy = sorted(
+            (h for h in self.hosts if h.healthy),
+            key=lambda h: (h.load(), h.requests / h.endpoint.weight),
+        )
+        down = sorted(
+            (h for h in self.hosts if not h.healthy),
+            key=lambda h: h.down_until,
+        )
+        if affinity is not None:
+            pinned = self.pinned.get(affinity)
+            if pinned in healthy:
+                healthy.remove(pinned)
+                healthy.insert(0, pinned)
+        return healthy + down
+
+    async def stream(
+        self, endpoint: str, affinity: Any = None, **request: Any
+    ) -> AsyncIterator[Any]:
+        """Stream a response to a `chat` or `generate` request."""
+        for host in self.candidates(affinity):
+            started = False
+            parts = None
+            host.begin()
+            try:
+                method = getattr(host.client, endpoint)
+                parts = await method(stream=True, **request)
+                async for part in parts:
+                    if not started and affinity is not None:
+                        self.pinned[affinity] = host
+                    started = True
+                    host.failed = False
+                    host.parts += 1
+                    yield part
+                return
+            except HOST_ERRORS as e:
+                host.fail(self.retry_after)
+                if started:
+                    raise HostError(
+                        f"lost connection to {host.endpoint.url}: {e}"
+                    )
+                LOG.warning("host %s failed: %s", host.endpoint.url, e)
+            finally:
+                if parts is not None:
+                    await parts.aclose()
+                host.end()
+        raise HostError("no model host is reachable")
+
+    async def chat(
+        self, affinity: Any = None, **request: Any
+    ) -> AsyncIterator[Any]:
+        return self.stream("chat", affinity, **request)
+
+    async def generate(self, **request: Any) -> AsyncIterator[Any]:
+        return self.stream("generate", **request)
+
+    async def check(self, timeout: float = 5.0) -> list[Optional[float]]:
+        """Probe every host, marking unreachable ones down.
+
+        Return each host's response time in seconds, or None if it is down.
+        """
+
+        async def probe(host: Host) -> Optional[float]:
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(host.client.ps(), timeout)
+            except (*HOST_ERRORS, asyncio.TimeoutError) as e:
+                LOG.warning("host %s is down: %s", host.endpoint.url, e)
+                host.fail(self.retry_after)
+                return None
+            host.failed = False
+            return time.perf_counter() - start
+
+        return await asyncio.gather(*(probe(h) for h in self.hosts))
+
+    def metrics(self) -> list[dict[str, Any]]:
+        return [host.metrics() for host in self.hosts]
+
+    def log_metrics(self) -> None:
+        for m in self.metrics():
+            LOG.info(
+                "host %s: %i requests, %i failures, %.1f tokens/s",
+                m["host"],
+                m["requests"],
+                m["failures"],
+                m["tokens_per_s"],
+            )
+
+
+def endpoints(hosts: Iterable[str | dict]) -> tuple[Endpoint, ...]:
+    """Parse a `hosts` configuration list.
+
+    Each entry is a URL or a table with a `url` and an optional `weight`.
+    """
+    return tuple(
+        Endpoint(h) if isinstance(h, str) else Endpoint(**h) for h in hosts
+    )
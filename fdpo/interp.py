@@ -0,0 +1,68 @@
+from . import lang, lib
+from .util import Env
+import functools
+from typing import assert_never
+
+
+class CycleError(Exception):
+    pass
+
+
+def uses(expr: lang.Expression) -> list[str]:
+    """Get the variables an expression reads."""
+    if isinstance(expr, lang.Lookup):
+        return [expr.var]
+    elif isinstance(expr, lang.Call):
+        return [var for arg in expr.inputs for var in uses(arg)]
+    elif isinstance(expr, lang.Literal):
+        return []
+    else:
+        assert_never(expr)
+
+
+@functools.lru_cache(maxsize=256)
+def schedule(prog: lang.Program) -> list[lang.Assignment]:
+    """Order a program's assignments so that every value is defined first.
+
+    Raise `CycleError` if some value depends on itself.
+    """
+    asgts = {asgt.dest: asgt for asgt in prog.assignments}
+    order = []
+    done = set(prog.inputs)
+    active = set()
+    for root in asgts:
+        # An iterative depth-first search, so long chains are fine.
+        stack = [(root, False)]
+        while stack:
+            name, finished = stack.pop()
+            if finished:
+                active.remove(name)
+                done.add(name)
+                order.append(asgts[name])
+            elif name not in done:
+                if name in active:
+                    raise CycleError(f"{name} depends on itself")
+                active.add(name)
+                stack.append((name, True))
+                stack.extend((var, False) for var in uses(asgts[name].expr))
+    return order
+
+
+def eval_expr(expr: lang.Expression, values: Env) -> int:
+    if isinstance(expr, lang.Lookup):
+        return values[expr.var]
+    elif isinstance(expr, lang.Call):
+        args = [eval_expr(arg, values) for arg in expr.inputs]
+        return lib.FUNCTIONS[expr.func].eval(expr.params, args)
+    elif isinstance(expr, lang.Literal):
+        return expr.value
+    else:
+        assert_never(expr)
+
+
+def interp(prog: lang.Program, env: Env) -> Env:
+    """Run a (checked) program on concrete inputs, without a solver."""
+    values = dict(env)
+    for asgt in schedule(prog):
+        values[asgt.dest] = eval_expr(asgt.expr, values)
+    return {name: values[name] for name in prog.outputs}
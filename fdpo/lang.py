@@ -1,7 +1,9 @@
+from . import trace
 from typing import Optional, assert_never
 import lark
 import enum
 import dataclasses
+import functools
 from dataclasses import dataclass
 
 GRAMMAR = r"""
@@ -100,6 +102,20 @@ class Call:
     func: str
     params: list[int]
     inputs: list["Expression"]
+    _hash: int = dataclasses.field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # Cache a structural hash so that (possibly deep) expressions can be
+        # used as memoization keys in constant time.
+        h = hash((self.func, tuple(self.params), tuple(self.inputs)))
+        object.__setattr__(self, "_hash", h)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __reduce__(self):
+        # Recompute the hash on unpickling: string hashes are per-process.
+        return (Call, (self.func, self.params, self.inputs))
 
     @classmethod
     def parse(cls, tree) -> "Call":
@@ -197,6 +213,7 @@ class Program:
     outputs: dict[str, Port]
     assignments: list[Assignment]
     temps: dict[str, Port] = dataclasses.field(init=False)
+    _hash: int = dataclasses.field(init=False, repr=False, compare=False)
 
     def __post_init__(self):
         temps = {
@@ -205,6 +222,20 @@ class Program:
             if a.dest not in self.outputs and a.width is not None
         }
         object.__setattr__(self, "temps", temps)
+        h = hash(
+            (
+                frozenset(self.inputs.values()),
+                frozenset(self.outputs.values()),
+                tuple(self.assignments),
+            )
+        )
+        object.__setattr__(self, "_hash", h)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __reduce__(self):
+        return (Program, (self.inputs, self.outputs, self.assignments))
 
     @staticmethod
     def parse_decls(tree) -> tuple[dict[str, Port], dict[str, Port]]:
@@ -265,12 +296,21 @@ class RawLiteralError(TreeError):
         super().__init__(tree, msg)
 
 
-def parse(program: str) -> tuple[Program, Optional[Program]]:
-    parser = lark.Lark(
+@functools.cache
+def parser() -> lark.Lark:
+    """Get the (expensive to construct) parser, built once and reused."""
+    return lark.Lark(
         GRAMMAR, parser="earley", start="prog", propagate_positions=True
     )
-    try:
-        tree = parser.parse(program)
-    except lark.exceptions.UnexpectedInput as e:
-        raise ParseError(str(e))
-    return Program.parse(tree)
+
+
+def parse(program: str) -> tuple[Program, Optional[Program]]:
+    with trace.span("parse"):
+        try:
+            tree = parser().parse(program)
+        except lark.exceptions.UnexpectedInput as e:
+            # List expected tokens in a stable order, not set order.
+            if isinstance(e, lark.exceptions.UnexpectedCharacters):
+                e.allowed = sorted(e.allowed)
+            raise ParseError(str(e))
+        return Program.parse(tree)
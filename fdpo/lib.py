@@ -1,27 +1,12 @@
 from dataclasses import dataclass
-from typing import Callable
-from pysmt.fnode import FNode
-from pysmt.shortcuts import (
-    BVAdd,
-    BVSub,
-    BVMul,
-    BVUDiv,
-    BVURem,
-    Ite,
-    NotEquals,
-    BV,
-    BVUGT,
-    BVULT,
-    BVLShl,
-    BVLShr,
-    BVAShr,
-    BVAnd,
-    BVOr,
-    BVXor,
-    BVSExt,
-    BVZExt,
-    BVExtract,
-)
+from typing import Callable, TYPE_CHECKING
+from .util import lazy_import
+
+if TYPE_CHECKING:
+    from pysmt.fnode import FNode
+
+# The solver library is only needed to encode calls, so load it on first use.
+shortcuts = lazy_import("pysmt.shortcuts")
 
 
 @dataclass(frozen=True)
@@ -36,10 +21,20 @@ class Function:
     params: int
     sig: Callable[[list[int]], Signature]
     cost: Callable[[list[int]], int]
-    smt: Callable[[list[int], list[FNode]], FNode]
+    smt: Callable[[list[int], list["FNode"]], "FNode"]
+    eval: Callable[[list[int], list[int]], int]  # Concrete semantics.
     help: str
 
 
+def mask(width: int) -> int:
+    return (1 << width) - 1
+
+
+def signed(value: int, width: int) -> int:
+    """Interpret an unsigned value as a two's complement one."""
+    return value - (1 << width) if value >> (width - 1) else value
+
+
 def binary_sig(params: list[int]) -> Signature:
     return Signature([params[0], params[0]], params[0])
 
@@ -66,7 +61,8 @@ FUNCTIONS = {
             1,
             binary_sig,
             lambda p: p[0],
-            lambda _, a: BVAdd(*a),
+            lambda _, a: shortcuts.BVAdd(*a),
+            lambda p, a: (a[0] + a[1]) & mask(p[0]),
             "add[N](x: N, y: N) -> N: Integer addition.",
         ),
         Function(
@@ -74,7 +70,8 @@ FUNCTIONS = {
             1,
             binary_sig,
             lambda p: p[0],
-            lambda _, a: BVSub(*a),
+            lambda _, a: shortcuts.BVSub(*a),
+            lambda p, a: (a[0] - a[1]) & mask(p[0]),
             "sub[N](x: N, y: N) -> N: Integer subtraction.",
         ),
         Function(
@@ -82,7 +79,8 @@ FUNCTIONS = {
             1,
             binary_sig,
             lambda p: p[0] * 10,
-            lambda _, a: BVMul(*a),
+            lambda _, a: shortcuts.BVMul(*a),
+            lambda p, a: (a[0] * a[1]) & mask(p[0]),
             "mul[N](x: N, y: N) -> N: Unsigned integer multiplication.",
         ),
         Function(
@@ -90,7 +88,9 @@ FUNCTIONS = {
             1,
             binary_sig,
             lambda p: p[0] * 100,
-            lambda _, a: BVUDiv(*a),
+            lambda _, a: shortcuts.BVUDiv(*a),
+            # Like SMT-LIB, division by zero gives all ones.
+            lambda p, a: a[0] // a[1] if a[1] else mask(p[0]),
             "div[N](x: N, y: N) -> N: Unsigned integer (rounded) division.",
         ),
         Function(
@@ -98,7 +98,8 @@ FUNCTIONS = {
             1,
             binary_sig,
             lambda p: p[0] * 100,
-            lambda _, a: BVURem(*a),
+            lambda _, a: shortcuts.BVURem(*a),
+            lambda p, a: a[0] % a[1] if a[1] else a[0],
             "mod[N](x: N, y: N) -> N: Unsigned integer modulus (remainder).",
         ),
         Function(
@@ -106,7 +107,10 @@ FUNCTIONS = {
             1,
             lambda p: Signature([1, p[0], p[0]], p[0]),
             lambda p: p[0],
-            lambda _, a: Ite(NotEquals(a[0], BV(0, 1)), a[1], a[2]),
+            lambda _, a: shortcuts.Ite(
+                shortcuts.NotEquals(a[0], shortcuts.BV(0, 1)), a[1], a[2]
+            ),
+            lambda _, a: a[1] if a[0] else a[2],
             "if[N](c: 1, a: N, b: N) -> N: If `c` is 1, then `a`. Otherwise, `b`.",
         ),
         Function(
@@ -114,7 +118,10 @@ FUNCTIONS = {
             1,
             cmp_sig,
             lambda p: p[0],
-            lambda _, a: Ite(BVUGT(*a), BV(1, 1), BV(0, 1)),
+            lambda _, a: shortcuts.Ite(
+                shortcuts.BVUGT(*a), shortcuts.BV(1, 1), shortcuts.BV(0, 1)
+            ),
+            lambda _, a: int(a[0] > a[1]),
             "gt[N](x: N, y: N) -> 1: Unsigned integer greater-than comparison.",
         ),
         Function(
@@ -122,7 +129,10 @@ FUNCTIONS = {
             1,
             cmp_sig,
             lambda p: p[0],
-            lambda _, a: Ite(BVULT(*a), BV(1, 1), BV(0, 1)),
+            lambda _, a: shortcuts.Ite(
+                shortcuts.BVULT(*a), shortcuts.BV(1, 1), shortcuts.BV(0, 1)
+            ),
+            lambda _, a: int(a[0] < a[1]),
             "lt[N](x: N, y: N) -> 1: Unsigned integer less-than comparison.",
         ),
         Function(
@@ -130,7 +140,8 @@ FUNCTIONS = {
             1,
             binary_sig,
             lambda p: p[0],
-            lambda _, a: BVLShl(*a),
+            lambda _, a: shortcuts.BVLShl(*a),
+            lambda p, a: (a[0] << a[1]) & mask(p[0]) if a[1] < p[0] else 0,
             "shl[N](x: N, d: N) -> N: Shift `x` left by `d` bits.",
         ),
         Function(
@@ -138,7 +149,8 @@ FUNCTIONS = {
             1,
             binary_sig,
             lambda p: p[0],
-            lambda _, a: BVLShr(*a),
+            lambda _, a: shortcuts.BVLShr(*a),
+            lambda _, a: a[0] >> a[1],
             "shr[N](x: N, d: N) -> N: Shift `x` right by `d` bits (logical, zero padded).",
         ),
         Function(
@@ -146,7 +158,8 @@ FUNCTIONS = {
             1,
             binary_sig,
             lambda p: p[0],
-            lambda _, a: BVAShr(*a),
+            lambda _, a: shortcuts.BVAShr(*a),
+            lambda p, a: (signed(a[0], p[0]) >> a[1]) & mask(p[0]),
             "ashr[N](x: N, d: N) -> N: Shift `x` right by `d` bits (arithmetic, sign extended).",
         ),
         Function(
@@ -154,7 +167,8 @@ FUNCTIONS = {
             1,
             binary_sig,
             lambda p: p[0],
-            lambda _, a: BVAnd(*a),
+            lambda _, a: shortcuts.BVAnd(*a),
+            lambda _, a: a[0] & a[1],
             "and[N](x: N, y: N) -> N: Bitwise and.",
         ),
         Function(
@@ -162,7 +176,8 @@ FUNCTIONS = {
             1,
             binary_sig,
             lambda p: p[0],
-            lambda _, a: BVOr(*a),
+            lambda _, a: shortcuts.BVOr(*a),
+            lambda _, a: a[0] | a[1],
             "or[N](x: N, y: N) -> N: Bitwise or.",
         ),
         Function(
@@ -170,7 +185,8 @@ FUNCTIONS = {
             1,
             binary_sig,
             lambda p: p[0],
-            lambda _, a: BVXor(*a),
+            lambda _, a: shortcuts.BVXor(*a),
+            lambda _, a: a[0] ^ a[1],
             "xor[N](x: N, y: N) -> N: Bitwise exclusive or.",
         ),
         Function(
@@ -178,7 +194,8 @@ FUNCTIONS = {
             2,
             ext_sig,
             lambda _: 0,
-            lambda p, a: BVSExt(a[0], p[1] - p[0]),
+            lambda p, a: shortcuts.BVSExt(a[0], p[1] - p[0]),
+            lambda p, a: signed(a[0], p[0]) & mask(p[1]),
             "sext[N, M](x: N) -> M: Sign-extend `x` from `N` bits to `M` bits.",
         ),
         Function(
@@ -186,7 +203,8 @@ FUNCTIONS = {
             2,
             ext_sig,
             lambda _: 0,
-            lambda p, a: BVZExt(a[0], p[1] - p[0]),
+            lambda p, a: shortcuts.BVZExt(a[0], p[1] - p[0]),
+            lambda _, a: a[0],
             "zext[N, M](x: N) -> M: Zero-extend `x` from `N` bits to `M` bits.",
         ),
         Function(
@@ -194,7 +212,8 @@ FUNCTIONS = {
             3,
             slice_sig,
             lambda _: 0,
-            lambda p, a: BVExtract(a[0], p[1], p[2]),
+            lambda p, a: shortcuts.BVExtract(a[0], p[1], p[2]),
+            lambda p, a: (a[0] >> p[1]) & mask(p[2] - p[1] + 1),
             "slice[N, L, H](x: N) -> (L-H+1): Extract the bits from `L` to `H` (inclusive) from `x`.",
         ),
     ]
@@ -0,0 +1,249 @@
+from . import lang, cost, check, smt
+import time
+import random
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tracemalloc
+from collections.abc import Callable, Iterator
+from typing import Any, Optional
+
+# Offline CLI modes measured by `bench_startup`, with their arguments.
+STARTUP_MODES = {
+    "print": [],
+    "cost": [],
+    "lib-help": [],
+    "smt": [],
+    "equiv-smt": [],
+    "run": ["a=1", "b=2", "c=3", "d=4"],
+    "equiv": [],
+    "gen": ["--size", "10"],
+}
+
+IMPORT_TIME_RE = re.compile(r"^import time:\s+(\d+) \|", re.M)
+
+
+def chain_prog(size: int, width: int = 32, seed: int = 0) -> lang.Program:
+    """Generate a large, well-formed program with `size` assignments.
+
+    Each temporary combines two earlier values with a random binary
+    operation, and the last temporary feeds the single output.
+    """
+    rng = random.Random(seed)
+    inputs = {name: lang.Port(name, width) for name in ("a", "b", "c", "d")}
+    outputs = {"out": lang.Port("out", width)}
+    names = list(inputs)
+    asgts = []
+    for i in range(size):
+        func = rng.choice(["add", "sub", "mul", "and", "or", "xor"])
+        args = [lang.Lookup(rng.choice(names[-8:])) for _ in range(2)]
+        dest = f"t{i}"
+        asgts.append(
+            lang.Assignment(dest, width, lang.Call(func, [width], args))
+        )
+        names.append(dest)
+    asgts.append(lang.Assignment("out", None, lang.Lookup(names[-1])))
+    return lang.Program(inputs, outputs, asgts)
+
+
+def tweak(prog: lang.Program, index: int) -> lang.Program:
+    """Replace the function in a single assignment of a program."""
+    asgts = list(prog.assignments)
+    old = asgts[index]
+    assert isinstance(old.expr, lang.Call)
+    func = "xor" if old.expr.func != "xor" else "or"
+    asgts[index] = lang.Assignment(
+        old.dest,
+        old.width,
+        lang.Call(func, old.expr.params, old.expr.inputs),
+    )
+    return lang.Program(prog.inputs, prog.outputs, asgts)
+
+
+def timeit(func: Callable[[], object], reps: int) -> float:
+    """Get the mean wall-clock time of a function in seconds."""
+    start = time.perf_counter()
+    for _ in range(reps):
+        func()
+    return (time.perf_counter() - start) / reps
+
+
+def bench_cost(size: int, reps: int = 100) -> dict[str, float]:
+    """Measure cost scoring on a large generated program.
+
+    Compare a cold score (empty caches), a repeated score of the same
+    program, and scores of fresh candidates that each differ from the
+    original in a single assignment.
+    """
+    prog = chain_prog(size)
+
+    def cold():
+        cost.score.cache_clear()
+        cost.score_expr.cache_clear()
+        cost.score(prog)
+
+    cold_time = timeit(cold, reps)
+    cost.score(prog)
+    warm_time = timeit(lambda: cost.score(prog), reps)
+
+    variants = [tweak(prog, i % size) for i in range(reps)]
+    it = iter(variants)
+    tweak_time = timeit(lambda: cost.score(next(it)), reps)
+
+    return {
+        "cold_us": cold_time * 1e6,
+        "warm_us": warm_time * 1e6,
+        "one_change_us": tweak_time * 1e6,
+    }
+
+
+def percentile(samples: list[float], q: float) -> float:
+    """Get a nearest-rank percentile (0 <= q <= 100) of sorted samples."""
+    index = max(0, min(len(samples) - 1, round(q / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+def measure(
+    func: Callable[[], object], reps: int, warmup: int
+) -> dict[str, float]:
+    """Get latency percentiles (in microseconds) and peak memory of a call.
+
+    Memory is traced in a separate run, so tracing does not skew the times.
+    """
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(reps):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "p50_us": percentile(times, 50) * 1e6,
+        "p90_us": percentile(times, 90) * 1e6,
+        "p99_us": percentile(times, 99) * 1e6,
+        "max_us": times[-1] * 1e6,
+        "peak_kb": peak / 1024,
+    }
+
+
+def stage_funcs(
+    src: str, seed: int = 0
+) -> Iterator[tuple[str, Callable[[], object]]]:
+    """Get a function to run each stage of the pipeline on a program."""
+    prog1, prog2 = lang.parse(src)
+    rng = random.Random(seed)
+    inputs = {
+        name: rng.getrandbits(port.width)
+        for name, port in prog1.inputs.items()
+    }
+
+    def score():
+        cost.score.cache_clear()
+        cost.score_expr.cache_clear()
+        cost.score(prog1)
+
+    yield "parse", lambda: lang.parse(src)
+    yield "check", lambda: check.check(prog1)
+    yield "score", score
+    yield "run", lambda: smt.run(prog1, inputs)
+    yield "equiv", lambda: smt.equiv(prog1, prog2 or prog1)
+
+
+def bench_stages(
+    filenames: list[str], sizes: list[int], reps: int = 20, warmup: int = 2
+) -> list[dict[str, Any]]:
+    """Measure each non-LLM stage on some programs.
+
+    Benchmark programs from files and generated programs of each size. The
+    `equiv` stage checks a program's two halves, if it has them, and
+    otherwise checks a program against itself.
+    """
+    progs = []
+    for filename in filenames:
+        with open(filename) as f:
+            name, _ = os.path.splitext(os.path.basename(filename))
+            progs.append((name, f.read()))
+    for size in sizes:
+        progs.append((f"chain{size}", chain_prog(size).pretty()))
+
+    rows = []
+    for name, src in progs:
+        try:
+            prog, _ = lang.parse(src)
+            check.check(prog)
+        except (lang.ParseError, check.CheckError):
+            continue  # Skip the deliberately broken tests.
+        size = len(prog.assignments)
+        for stage, func in stage_funcs(src):
+            rows.append(
+                {"stage": stage, "prog": name, "size": size}
+                | measure(func, reps, warmup)
+            )
+    return rows
+
+
+def bench_startup(reps: int = 5) -> list[dict[str, Any]]:
+    """Measure the startup cost of each offline CLI mode.
+
+    Run `fdpo` in a fresh interpreter with `-X importtime` on a small
+    program, and report the median total import time, number of modules
+    imported, and wall-clock time for each mode.
+    """
+    prog = chain_prog(4)
+    asgts = "\n".join(a.pretty() for a in prog.assignments)
+    src = f"{prog.pretty()}\n---\n{asgts}\n"
+
+    rows = []
+    for mode, args in STARTUP_MODES.items():
+        imports = []
+        walls = []
+        for _ in range(reps):
+            start = time.perf_counter()
+            proc = subprocess.run(
+                [sys.executable, "-X", "importtime", "-m", "fdpo", mode]
+                + args,
+                input=src,
+                capture_output=True,
+                text=True,
+            )
+            walls.append(time.perf_counter() - start)
+            times = [int(t) for t in IMPORT_TIME_RE.findall(proc.stderr)]
+            imports.append(sum(times))
+        rows.append(
+            {
+                "mode": mode,
+                "import_ms": statistics.median(imports) / 1000,
+                "modules": len(times),
+                "wall_ms": statistics.median(walls) * 1000,
+            }
+        )
+    return rows
+
+
+def regressions(
+    rows: list[dict[str, Any]],
+    baseline: list[dict[str, Any]],
+    threshold: float = 1.25,
+) -> list[tuple[str, str, float, float]]:
+    """Find stages whose median latency grew by more than `threshold`.
+
+    Return the stage, program, baseline median, and new median for each.
+    """
+    base = {(row["stage"], row["prog"]): row["p50_us"] for row in baseline}
+    out = []
+    for row in rows:
+        old: Optional[float] = base.get((row["stage"], row["prog"]))
+        if old and row["p50_us"] > old * threshold:
+            out.append((row["stage"], row["prog"], old, row["p50_us"]))
+    return out
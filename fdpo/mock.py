@@ -0,0 +1,238 @@
+from .cache import ResponseCache, cache_key
+import asyncio
+import json
+import re
+import datetime
+import itertools
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Optional
+
+PROG_RE = re.compile(
+    r"(?:optimize|program in our language):\s*```\n(.*?)```", re.S
+)
+PORT_RE = re.compile(r"^(in|out) (\w+): \d+;$", re.M)
+TOKEN_RE = re.compile(r"\s*\S+|\s+")
+ROW_RE = re.compile(r"^\| \d+ \|", re.M)
+
+
+@dataclass(frozen=True)
+class MockConfig:
+    rate: float = 200.0  # Generated tokens per second.
+    latency: float = 0.05  # Seconds before the first token.
+    prefill_rate: Optional[float] = None  # Prompt tokens per second.
+    concurrency: Optional[int] = None  # Simultaneous generations.
+    script: Optional[list[str]] = None  # Canned responses, in rotation.
+    replay: Optional[str] = None  # A response cache to serve from.
+
+
+def canned_command(prog: str, round: int) -> str:
+    """Generate an agent command about a program.
+
+    Rotate through `eval`, `check`, and `commit` commands on the original
+    program, which exercises each of those paths in the agent.
+    """
+    op = ["eval", "check", "commit"][round % 3]
+    if op == "eval":
+        inputs = [n for d, n in PORT_RE.findall(prog) if d == "in"]
+        op = " ".join(["eval"] + [f"{n}=0" for n in inputs])
+    return f"```\n{op}\n{prog.strip()}\n```\n"
+
+
+def canned_response(endpoint: str, request: dict) -> str:
+    """Make up a plausible response to a request."""
+    if endpoint == "chat":
+        text = "\n".join(m["content"] for m in request["messages"])
+        round = sum(1 for m in request["messages"] if m["role"] == "assistant")
+    else:
+        text = request["prompt"]
+        round = 0
+    match = PROG_RE.search(text)
+    prog = match.group(1) if match else ""
+
+    if endpoint == "chat":
+        return canned_command(prog, round)
+    elif "sets of input port values" in text:
+        # A request to run a program on a table of inputs.
+        outputs = [n for d, n in PORT_RE.findall(prog) if d == "out"]
+        rows = len(ROW_RE.findall(text))
+        lines = ["| # | " + " | ".join(outputs) + " |"]
+        lines.append("|---|" + "---|" * len(outputs))
+        for i in range(rows):
+            lines.append(f"| {i + 1} |" + " 0 |" * len(outputs))
+        return "\n".join(lines)
+    elif "input port values" in text:
+        # A request to run a program.
+        outputs = [n for d, n in PORT_RE.findall(prog) if d == "out"]
+        return "\n".join(f"{n} = 0" for n in outputs)
+    else:
+        # A one-shot optimization request.
+        return f"```\n{prog.strip()}\n```\n"
+
+
+class MockServer:
+    """A stand-in for an ollama server, for testing and profiling.
+
+    The server implements just enough of the `/api/chat` and `/api/generate`
+    streaming endpoints for `ollama.AsyncClient`, with configurable latency,
+    token rate, and concurrency. Responses come from a script, are replayed
+    from a response cache, or are canned commands derived from the prompt.
+    """
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.script = itertools.cycle(config.script) if config.script else None
+        self.cache = ResponseCache(config.replay) if config.replay else None
+        self.sem = (
+            asyncio.Semaphore(config.concurrency)
+            if config.concurrency
+            else nullcontext()
+        )
+        self.requests = 0
+        self.active = 0
+
+    def respond(self, endpoint: str, request: dict) -> str:
+        if self.cache:
+            if endpoint == "chat":
+                key = cache_key(
+                    endpoint=endpoint,
+                    model=request["model"],
+                    messages=request["messages"],
+                )
+            else:
+                key = cache_key(
+                    endpoint=endpoint,
+                    model=request["model"],
+                    prompt=request["prompt"],
+                )
+            if (resp := self.cache.get(key)) is not None:
+                return resp
+        if self.script:
+            return next(self.script)
+        return canned_response(endpoint, request)
+
+    async def generate(self, endpoint: str, request: dict, writer) -> None:
+        """Stream a response as newline-delimited JSON."""
+        config = self.config
+        resp = self.respond(endpoint, request)
+        if endpoint == "chat":
+            prompt = "".join(m["content"] for m in request["messages"])
+        else:
+            prompt = request["prompt"]
+        prompt_tokens = len(prompt) // 4 + 1
+
+        async with self.sem:
+            self.active += 1
+            try:
+                delay = config.latency
+                if config.prefill_rate:
+                    delay += prompt_tokens / config.prefill_rate
+                await asyncio.sleep(delay)
+
+                tokens = TOKEN_RE.findall(resp)
+                for token in tokens:
+                    if endpoint == "chat":
+                        part = {
+                            "message": {"role": "assistant", "content": token}
+                        }
+                    else:
+                        part = {"response": token}
+                    part |= {"model": request["model"], "done": False}
+                    writer.write(json.dumps(part).encode() + b"\n")
+                    await writer.drain()
+                    await asyncio.sleep(1 / config.rate)
+
+                final = {
+                    "model": request["model"],
+                    "created_at": datetime.datetime.now().isoformat(),
+                    "done": True,
+                    "done_reason": "stop",
+                    "prompt_eval_count": prompt_tokens,
+                    "eval_count": len(tokens),
+                }
+                if endpoint == "chat":
+                    final["message"] = {"role": "assistant", "content": ""}
+                else:
+                    final["response"] = ""
+                writer.write(json.dumps(final).encode() + b"\n")
+                await writer.drain()
+            finally:
+                self.active -= 1
+
+    async def handle(self, reader, writer) -> None:
+        """Handle a single HTTP request and close the connection."""
+        try:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                return  # The client connected but sent nothing.
+            method, path, _ = request_line.decode().split(" ", 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b""):
+                key, value = line.decode().split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            body = await reader.readexactly(length) if length else b""
+            self.requests += 1
+
+            match method, path:
+                case "POST", "/api/chat" | "/api/generate":
+                    endpoint = path.rsplit("/", 1)[1]
+                    writer.write(
+                        b"HTTP/1.1 200 OK\r\n"
+                        b"Content-Type: application/x-ndjson\r\n"
+                        b"Connection: close\r\n\r\n"
+                    )
+                    await self.generate(endpoint, json.loads(body), writer)
+                case "GET", "/api/version":
+                    self.reply(writer, 200, {"version": "0.0.0-mock"})
+                case "GET", "/api/ps":
+                    self.reply(
+                        writer, 200, {"models": [], "active": self.active}
+                    )
+                case _:
+                    self.reply(writer, 404, {"error": f"no route {path}"})
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def reply(writer, status: int, data: dict) -> None:
+        body = json.dumps(data).encode()
+        writer.write(
+            f"HTTP/1.1 {status} X\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode()
+            + body
+        )
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        """Start serving, returning the `asyncio.Server`."""
+        return await asyncio.start_server(
+            self.handle, host, port, backlog=1024
+        )
+
+
+async def serve(config: MockConfig, host: str, port: int) -> None:
+    server = await MockServer(config).start(host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def mock_config(config: dict) -> MockConfig:
+    """Build a mock server configuration from a config table."""
+    script = None
+    if path := config.get("script"):
+        # Canned responses, separated by lines containing only `===`.
+        with open(path) as f:
+            script = re.split(r"^===$\n?", f.read(), flags=re.M)
+    return MockConfig(
+        rate=config.get("rate", MockConfig.rate),
+        latency=config.get("latency", MockConfig.latency),
+        prefill_rate=config.get("prefill_rate"),
+        concurrency=config.get("concurrency"),
+        script=script,
+        replay=config.get("replay"),
+    )
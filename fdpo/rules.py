@@ -0,0 +1,367 @@
+from . import lang, check, cost, smt
+from .interp import CycleError, schedule, uses
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from typing import Optional
+import functools
+import os
+import sqlite3
+import time
+
+MAX_NODES = 64  # The largest expression to build by inlining, when mining.
+MAX_REWRITES = 100  # Rewrites to apply to one program.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rules (
+    lhs TEXT PRIMARY KEY,
+    rhs TEXT NOT NULL,
+    head TEXT NOT NULL,
+    gain INTEGER NOT NULL,
+    learned REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rules_head ON rules (head);
+"""
+
+
+@dataclass(frozen=True)
+class Rule:
+    """A proven rewrite from an expression to a cheaper one.
+
+    Each side is a program with one assignment, to `out`. Their inputs are
+    pattern variables (`_0`, `_1`, ...) that match any subexpression.
+    """
+
+    lhs: lang.Program
+    rhs: lang.Program
+
+    @property
+    def pattern(self) -> lang.Expression:
+        return self.lhs.assignments[0].expr
+
+    @property
+    def replacement(self) -> lang.Expression:
+        return self.rhs.assignments[0].expr
+
+    def gain(self) -> int:
+        return cost.score(self.lhs) - cost.score(self.rhs)
+
+    def pretty(self) -> str:
+        return f"{self.pattern.pretty()} => {self.replacement.pretty()}"
+
+
+def head(expr: lang.Expression) -> Optional[str]:
+    """Get the key that rules for an expression are indexed by."""
+    if isinstance(expr, lang.Call):
+        return f"{expr.func}[{', '.join(str(p) for p in expr.params)}]"
+    return None
+
+
+def subterms(expr: lang.Expression) -> Iterator[lang.Expression]:
+    yield expr
+    if isinstance(expr, lang.Call):
+        for arg in expr.inputs:
+            yield from subterms(arg)
+
+
+@functools.lru_cache(maxsize=1 << 14)
+def size(expr: lang.Expression) -> int:
+    if isinstance(expr, lang.Call):
+        return 1 + sum(size(arg) for arg in expr.inputs)
+    return 1
+
+
+def substitute(
+    expr: lang.Expression, values: dict[str, lang.Expression]
+) -> lang.Expression:
+    if isinstance(expr, lang.Lookup):
+        return values.get(expr.var, expr)
+    elif isinstance(expr, lang.Call):
+        inputs = [substitute(arg, values) for arg in expr.inputs]
+        return lang.Call(expr.func, expr.params, inputs)
+    return expr
+
+
+def inline(prog: lang.Program) -> dict[str, lang.Expression]:
+    """Get each output's expression with temporaries substituted in.
+
+    Temporaries whose expressions would grow beyond `MAX_NODES` are left as
+    variables.
+    """
+    values: dict[str, lang.Expression] = {}
+    for asgt in schedule(prog):
+        expr = substitute(asgt.expr, values)
+        if size(expr) <= MAX_NODES:
+            values[asgt.dest] = expr
+    return {name: values.get(name, lang.Lookup(name)) for name in prog.outputs}
+
+
+def generalize(
+    prog: lang.Program, old: lang.Expression, new: lang.Expression
+) -> Optional[Rule]:
+    """Make a rule from a pair of expressions in a program.
+
+    Variables and subexpressions that both sides share become pattern
+    variables. Literals stay as they are.
+    """
+    if not isinstance(old, lang.Call):
+        return None
+    shared = {
+        e for e in subterms(new) if not isinstance(e, lang.Literal)
+    } & set(subterms(old))
+    names: dict[lang.Expression, str] = {}
+
+    def pattern(expr: lang.Expression) -> lang.Expression:
+        if isinstance(expr, lang.Literal):
+            return expr
+        if expr in shared or isinstance(expr, lang.Lookup):
+            return lang.Lookup(names.setdefault(expr, f"_{len(names)}"))
+        assert isinstance(expr, lang.Call)
+        return lang.Call(
+            expr.func, expr.params, [pattern(arg) for arg in expr.inputs]
+        )
+
+    def replacement(expr: lang.Expression) -> Optional[lang.Expression]:
+        if expr in names:
+            return lang.Lookup(names[expr])
+        if isinstance(expr, lang.Literal):
+            return expr
+        if isinstance(expr, lang.Lookup):
+            return None  # Not bound by the pattern.
+        inputs = [replacement(arg) for arg in expr.inputs]
+        if any(arg is None for arg in inputs):
+            return None
+        return lang.Call(expr.func, expr.params, inputs)  # type: ignore
+
+    lhs = pattern(old)
+    rhs = replacement(new)
+    if rhs is None:
+        return None
+    try:
+        inputs = {
+            name: lang.Port(name, check.check_expr(prog, expr))
+            for expr, name in names.items()
+        }
+        outputs = {"out": lang.Port("out", check.check_expr(prog, old))}
+        rule = Rule(
+            lang.Program(inputs, outputs, [lang.Assignment("out", None, lhs)]),
+            lang.Program(inputs, outputs, [lang.Assignment("out", None, rhs)]),
+        )
+        check.check(rule.rhs)
+    except check.CheckError:
+        return None
+    return rule
+
+
+def mine_pair(
+    prog: lang.Program, old: lang.Expression, new: lang.Expression
+) -> Optional[list[Rule]]:
+    """Find proven rules that explain how one expression became another.
+
+    Anti-unify the expressions: where they have the same operator, explain
+    each pair of differing arguments separately; otherwise (or if that
+    fails) generalize the whole pair. Return None if the difference cannot
+    be explained by equivalent rewrites.
+    """
+    if old == new:
+        return []
+    if (
+        isinstance(old, lang.Call)
+        and isinstance(new, lang.Call)
+        and head(old) == head(new)
+        and len(old.inputs) == len(new.inputs)
+    ):
+        rules = []
+        for old_arg, new_arg in zip(old.inputs, new.inputs):
+            found = mine_pair(prog, old_arg, new_arg)
+            if found is None:
+                break
+            rules += found
+        else:
+            return rules
+
+    rule = generalize(prog, old, new)
+    if rule is None or smt.equiv(rule.lhs, rule.rhs):
+        return None
+    return [rule] if rule.gain() > 0 else []
+
+
+def mine(old: lang.Program, new: lang.Program) -> list[Rule]:
+    """Mine rules from an optimization of a program."""
+    try:
+        old_exprs = inline(old)
+        new_exprs = inline(new)
+    except CycleError:
+        return []
+    rules = {}
+    for name in old.outputs:
+        found = mine_pair(old, old_exprs[name], new_exprs[name])
+        for rule in found or []:
+            rules.setdefault(rule.pretty(), rule)
+    return list(rules.values())
+
+
+def match(
+    pattern: lang.Expression,
+    expr: lang.Expression,
+    defs: dict[str, lang.Expression],
+    binding: dict[str, lang.Expression],
+) -> bool:
+    """Match a pattern against an expression, looking through temporaries."""
+    if isinstance(pattern, lang.Lookup):
+        if pattern.var in binding:
+            return binding[pattern.var] == expr
+        binding[pattern.var] = expr
+        return True
+    while isinstance(expr, lang.Lookup) and expr.var in defs:
+        expr = defs[expr.var]
+    if isinstance(pattern, lang.Literal):
+        return (
+            isinstance(expr, lang.Literal)
+            and expr.width == pattern.width
+            and expr.value == pattern.value
+        )
+    assert isinstance(pattern, lang.Call)
+    return (
+        isinstance(expr, lang.Call)
+        and expr.func == pattern.func
+        and expr.params == pattern.params
+        and len(expr.inputs) == len(pattern.inputs)
+        and all(
+            match(p, e, defs, binding)
+            for p, e in zip(pattern.inputs, expr.inputs)
+        )
+    )
+
+
+def rewrites(
+    expr: lang.Expression,
+    rules: dict[str, list[Rule]],
+    defs: dict[str, lang.Expression],
+) -> Iterator[lang.Expression]:
+    """Generate the expressions that one rule application can produce."""
+    if not isinstance(expr, lang.Call):
+        return
+    for rule in rules.get(head(expr) or "", []):
+        binding: dict[str, lang.Expression] = {}
+        if match(rule.pattern, expr, defs, binding):
+            yield substitute(rule.replacement, binding)
+    for i, arg in enumerate(expr.inputs):
+        for new_arg in rewrites(arg, rules, defs):
+            inputs = expr.inputs[:i] + [new_arg] + expr.inputs[i + 1 :]
+            yield lang.Call(expr.func, expr.params, inputs)
+
+
+def prune(prog: lang.Program) -> lang.Program:
+    """Remove assignments to temporaries that no output depends on."""
+    defs = {asgt.dest: asgt for asgt in prog.assignments}
+    live = set()
+    stack = list(prog.outputs)
+    while stack:
+        name = stack.pop()
+        if name not in live and name in defs:
+            live.add(name)
+            stack.extend(uses(defs[name].expr))
+    return lang.Program(
+        prog.inputs,
+        prog.outputs,
+        [asgt for asgt in prog.assignments if asgt.dest in live],
+    )
+
+
+def heads(prog: lang.Program) -> set[str]:
+    return {
+        h
+        for asgt in prog.assignments
+        for expr in subterms(asgt.expr)
+        if (h := head(expr))
+    }
+
+
+def rewrite(prog: lang.Program, rules: list[Rule]) -> tuple[lang.Program, int]:
+    """Greedily apply rules while they make a program cheaper.
+
+    Return the new program and the number of rewrites applied.
+    """
+    try:
+        schedule(prog)
+    except CycleError:
+        return prog, 0
+    by_head: dict[str, list[Rule]] = {}
+    for rule in sorted(rules, key=Rule.gain, reverse=True):
+        by_head.setdefault(head(rule.pattern) or "", []).append(rule)
+
+    count = 0
+    while count < MAX_REWRITES and (new_prog := step(prog, by_head)):
+        prog = new_prog
+        count += 1
+    return prog, count
+
+
+def step(
+    prog: lang.Program, rules: dict[str, list[Rule]]
+) -> Optional[lang.Program]:
+    """Find one rule application that makes a program cheaper."""
+    old_cost = cost.score(prog)
+    defs = {asgt.dest: asgt.expr for asgt in prog.assignments}
+    for i, asgt in enumerate(prog.assignments):
+        for expr in rewrites(asgt.expr, rules, defs):
+            asgts = list(prog.assignments)
+            asgts[i] = lang.Assignment(asgt.dest, asgt.width, expr)
+            new_prog = prune(lang.Program(prog.inputs, prog.outputs, asgts))
+            if cost.score(new_prog) < old_cost:
+                return new_prog
+    return None
+
+
+class RuleStore:
+    """A database of learned rules, indexed by the operator they rewrite."""
+
+    def __init__(self, path: str):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def add(self, rule: Rule) -> bool:
+        """Store a rule, unless a rule for the same pattern is as good.
+
+        Return True if the rule was new or better.
+        """
+        cur = self.db.execute(
+            "INSERT INTO rules (lhs, rhs, head, gain, learned) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (lhs) DO UPDATE SET rhs = excluded.rhs, "
+            "gain = excluded.gain, learned = excluded.learned "
+            "WHERE excluded.gain > rules.gain",
+            (
+                rule.lhs.pretty(),
+                rule.rhs.pretty(),
+                head(rule.pattern),
+                rule.gain(),
+                time.time(),
+            ),
+        )
+        return cur.rowcount > 0
+
+    def lookup(self, heads: Iterable[str]) -> list[Rule]:
+        """Get the rules for some operators."""
+        heads = list(heads)
+        marks = ", ".join("?" for _ in heads)
+        rows = self.db.execute(
+            f"SELECT lhs, rhs FROM rules WHERE head IN ({marks})", heads
+        )
+        return [load_rule(lhs, rhs) for lhs, rhs in rows]
+
+    def all(self) -> list[Rule]:
+        rows = self.db.execute("SELECT lhs, rhs FROM rules ORDER BY head")
+        return [load_rule(lhs, rhs) for lhs, rhs in rows]
+
+    def close(self) -> None:
+        self.db.close()
+
+
+@functools.lru_cache(maxsize=1024)
+def load_rule(lhs: str, rhs: str) -> Rule:
+    return Rule(lang.parse(lhs)[0], lang.parse(rhs)[0])
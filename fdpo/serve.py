@@ -0,0 +1,298 @@
+from . import lang, check, cost, smt, trace, verify
+from .ask import Asker, AskError
+from .util import Env, parse_int
+import asyncio
+import functools
+import json
+import logging
+import sys
+from collections import deque
+from typing import Any, Optional
+from collections.abc import Awaitable, Callable, Iterable
+
+LOG = logging.getLogger("fdpo")
+
+# Operations that run entirely in a worker process.
+WORKER_OPS = ["parse", "check", "run", "equiv", "cost", "smt"]
+
+# Errors that are the request's fault, reported in the response.
+REQUEST_ERRORS = (
+    lang.ParseError,
+    check.CheckError,
+    smt.InputError,
+    AskError,
+)
+
+
+class RequestError(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=1024)
+def parse(src: str) -> tuple[lang.Program, Optional[lang.Program]]:
+    """Parse and check a program, reusing recent results."""
+    prog1, prog2 = lang.parse(src)
+    check.check(prog1)
+    if prog2:
+        check.check(prog2)
+    return prog1, prog2
+
+
+def get_field(request: dict, name: str) -> Any:
+    try:
+        return request[name]
+    except KeyError:
+        raise RequestError(f"missing field `{name}`")
+
+
+def get_source(request: dict) -> str:
+    """Get a request's program, given inline (`prog`) or by path (`file`)."""
+    if "prog" in request or "file" not in request:
+        return get_field(request, "prog")
+    try:
+        with open(request["file"]) as f:
+            return f.read()
+    except OSError as e:
+        raise RequestError(f"could not read {request['file']}: {e.strerror}")
+
+
+def get_inputs(request: dict) -> Env:
+    """Get a request's inputs, as integers or strings like `16d42`."""
+    inputs = get_field(request, "inputs")
+    if not isinstance(inputs, dict):
+        raise RequestError("`inputs` must be an object")
+    env = {}
+    for name, value in inputs.items():
+        if isinstance(value, str):
+            try:
+                value = parse_int(value)
+            except ValueError as e:
+                raise RequestError(f"input `{name}`: {e}")
+        elif not isinstance(value, int) or isinstance(value, bool):
+            raise RequestError(f"input `{name}` is not an integer")
+        env[name] = value
+    return env
+
+
+def handle(request: dict) -> dict:
+    """Perform a request that does not involve a model.
+
+    Runs in a worker process, whose parser, solver environment, and caches
+    stay warm between requests.
+    """
+    op = get_field(request, "op")
+    match op:
+        case "parse":
+            prog, _ = lang.parse(get_source(request))
+            return {"prog": prog.pretty()}
+        case "check":
+            parse(get_source(request))
+            return {}
+        case "run":
+            prog, _ = parse(get_source(request))
+            return {"outputs": smt.run(prog, get_inputs(request))}
+        case "equiv":
+            prog1, prog2 = parse(get_source(request))
+            if "other" in request:
+                prog2, _ = parse(request["other"])
+            if not prog2:
+                raise RequestError("equiv needs two programs")
+            ce = smt.equiv(prog1, prog2)
+            if ce:
+                return {
+                    "equivalent": False,
+                    "inputs": ce.inputs,
+                    "differing_outputs": ce.differing_outputs,
+                }
+            return {"equivalent": True}
+        case "cost":
+            prog, _ = parse(get_source(request))
+            return {"cost": cost.score(prog)}
+        case "smt":
+            from pysmt.environment import Environment
+            from pysmt.shortcuts import to_smtlib
+
+            prog, _ = parse(get_source(request))
+            # Keep the formula out of the worker's long-lived environment.
+            with Environment():
+                _, phi = smt.prog_formula(prog)
+                return {"smt": to_smtlib(phi)}
+        case _:
+            raise RequestError(f"unknown operation `{op}`")
+
+
+def respond(request: dict) -> dict:
+    """Handle a request, reporting any errors in the response."""
+    try:
+        result = {"ok": True} | handle(request)
+    except (RequestError, *REQUEST_ERRORS) as e:
+        result = error(e)
+    if "id" in request:
+        result["id"] = request["id"]
+    return result
+
+
+def error(exc: Exception) -> dict:
+    message = getattr(exc, "message", None) or str(exc)
+    return {"ok": False, "error": message, "kind": type(exc).__name__}
+
+
+class Server:
+    """Answer JSON-lines requests, concurrently, with warm state.
+
+    Each line is a JSON object with an `op` (one of `WORKER_OPS`, `opt`, or
+    `stats`), a program source in `prog` (or a path to one in `file`), and
+    other operation-specific fields. An optional `id` is copied into the
+    response. Responses are written as soon as they are ready, so they may
+    arrive out of order.
+    """
+
+    def __init__(
+        self,
+        verifier: verify.Verifier,
+        asker: Optional[Asker] = None,
+        max_pending: Optional[int] = None,
+    ):
+        self.verifier = verifier
+        self.asker = asker
+        self.max_pending = max_pending or 4 * verifier.workers
+        self.pending = asyncio.Semaphore(self.max_pending)
+        self.requests = 0
+
+    async def handle(self, request: dict) -> dict:
+        op = request.get("op")
+        if op in WORKER_OPS:
+            return await self.verifier.submit(respond, request)
+        elif op == "opt":
+            if self.asker is None:
+                result = error(RequestError("no model configured"))
+            else:
+                try:
+                    prog, _ = parse(get_field(request, "prog"))
+                    new_prog, rounds, _ = await self.asker.opt(prog)
+                    result = {
+                        "ok": True,
+                        "prog": new_prog.pretty(),
+                        "cost": cost.score(new_prog),
+                        "rounds": rounds,
+                    }
+                except (RequestError, *REQUEST_ERRORS) as e:
+                    result = error(e)
+        elif op == "stats":
+            # Gauges for this (front-end) process, to watch for leaks.
+            result = {"ok": True, "requests": self.requests} | trace.gauges()
+            if self.asker is not None:
+                result |= {
+                    "responses": self.asker.responses,
+                    "stopped_early": self.asker.stopped_early,
+                    "trailing_tokens": self.asker.trailing_tokens,
+                }
+        else:
+            result = error(RequestError(f"unknown operation `{op}`"))
+        if "id" in request:
+            result["id"] = request["id"]
+        return result
+
+    async def answer(self, request: dict) -> dict:
+        """Handle a request, reporting even unexpected errors in-band."""
+        try:
+            return await self.handle(request)
+        except Exception as e:
+            LOG.exception("request failed")
+            result = error(e)
+            if "id" in request:
+                result["id"] = request["id"]
+            return result
+
+    async def handle_line(self, line: bytes, write) -> None:
+        try:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request is not an object")
+            except ValueError as e:
+                result = error(RequestError(f"invalid request: {e}"))
+            else:
+                result = await self.answer(request)
+            write((json.dumps(result) + "\n").encode())
+        finally:
+            self.pending.release()
+
+    async def serve(
+        self,
+        readline: Callable[[], Awaitable[bytes]],
+        write: Callable[[bytes], object],
+    ) -> None:
+        """Answer requests from a stream until it ends."""
+        tasks = set()
+        while line := await readline():
+            if not line.strip():
+                continue
+            self.requests += 1
+            # Stop reading while too many requests are in flight.
+            await self.pending.acquire()
+            task = asyncio.create_task(self.handle_line(line, write))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+    async def batch(
+        self,
+        requests: Iterable[dict],
+        write: Callable[[dict], object],
+        ordered: bool = True,
+    ) -> None:
+        """Answer a batch of requests, writing responses in input order.
+
+        Otherwise, responses are written in completion order. Either way, at
+        most `max_pending` requests are in flight (or waiting to be written)
+        at once.
+        """
+        window: deque[asyncio.Task[dict]] = deque()
+        for request in requests:
+            if len(window) >= self.max_pending:
+                if ordered:
+                    write(await window.popleft())
+                else:
+                    done, _ = await asyncio.wait(
+                        window, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        window.remove(task)
+                        write(task.result())
+            window.append(asyncio.create_task(self.answer(request)))
+        if ordered:
+            while window:
+                write(await window.popleft())
+        else:
+            for next_done in asyncio.as_completed(window):
+                write(await next_done)
+
+    async def serve_stdio(self) -> None:
+        # Read in a thread, because stdin might be a regular file.
+        def readline() -> Awaitable[bytes]:
+            return asyncio.to_thread(sys.stdin.buffer.readline)
+
+        def write(data: bytes) -> None:
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+
+        await self.serve(readline, write)
+
+    async def serve_unix(self, path: str) -> None:
+        async def connection(reader, writer):
+            try:
+                await self.serve(reader.readline, writer.write)
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        await self.verifier.start()
+        server = await asyncio.start_unix_server(
+            connection, path, limit=1 << 24
+        )
+        LOG.info("serving on %s", path)
+        async with server:
+            await server.serve_forever()
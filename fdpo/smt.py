@@ -58,14 +58,21 @@ def prog_formula(prog: lang.Program) -> tuple[SymbolEnv, FNode]:
     return env, prog_env_formula(prog, env)
 
 
+def differ_formulas(
+    prog: lang.Program, env1: SymbolEnv, env2: SymbolEnv
+) -> tuple[FNode, FNode]:
+    """Constrain two programs' inputs to match and some output to differ."""
+    inputs = And(Equals(env1[port], env2[port]) for port in prog.inputs)
+    outputs = Or(NotEquals(env1[port], env2[port]) for port in prog.outputs)
+    return inputs, outputs
+
+
 def equiv_formula(prog1: lang.Program, prog2: lang.Program) -> FNode:
     env1 = symbol_env(prog1, "prog1_")
     phi1 = prog_env_formula(prog1, env1)
     env2 = symbol_env(prog2, "prog2_")
     phi2 = prog_env_formula(prog2, env2)
-    inputs = And(Equals(env1[port], env2[port]) for port in prog1.inputs)
-    outputs = Or(NotEquals(env1[port], env2[port]) for port in prog1.outputs)
-    return And(phi1, phi2, inputs, outputs)
+    return And(phi1, phi2, *differ_formulas(prog1, env1, env2))
 
 
 def to_smt(prog: lang.Program) -> str:
@@ -153,6 +160,35 @@ def run(prog: lang.Program, env: Env) -> Env:
     return {k: v for k, v in model.items() if k in prog.outputs}
 
 
+def run_many(prog: lang.Program, envs: list[Env]) -> list[Env]:
+    """Run a program on several inputs, sharing one solver instance."""
+    for env in envs:
+        check_input(prog, env)
+
+    results = []
+    with Environment():
+        symb_env, prog_f = prog_formula(prog)
+        with get_solver("z3") as solver:
+            solver.add_assertion(prog_f)
+            for env in envs:
+                solver.push()
+                for var, value in env.items():
+                    solver.add_assertion(
+                        Equals(
+                            symb_env[var], BV(value, prog.inputs[var].width)
+                        )
+                    )
+                assert solver.solve(), "unsat"
+                results.append(
+                    {
+                        name: solver.get_value(symb_env[name]).bv2nat()
+                        for name in prog.outputs
+                    }
+                )
+                solver.pop()
+    return results
+
+
 @dataclass(frozen=True)
 class Counterexample:
     inputs: Env
@@ -168,6 +204,15 @@ class Counterexample:
             out.append(f"  {key} = {value1} vs. {value2}")
         return "\n".join(out)
 
+    def compact(self) -> str:
+        """A one-line description of the counter-example."""
+        inputs = ", ".join(f"{k} = {v}" for k, v in self.inputs.items())
+        outputs = ", ".join(
+            f"{k} = {v1} vs. {v2}"
+            for k, (v1, v2) in self.differing_outputs.items()
+        )
+        return f"{inputs} gives {outputs}"
+
 
 def equiv(
     prog1: lang.Program, prog2: lang.Program
@@ -178,21 +223,66 @@ def equiv(
         model = solve(phi)
     if not model:
         return None
+    return counterexample(prog1, model, "prog1_", "prog2_")
 
-    # Found a counter-example. Let's belt-and-suspenders check that it's a
-    # real counter-example, and also extract the inputs & differing outputs.
+
+def counterexample(
+    prog: lang.Program, model: Env, prefix1: str, prefix2: str
+) -> Counterexample:
+    """Extract a counter-example from a model of an `equiv_formula`."""
+    # Let's belt-and-suspenders check that it's a real counter-example, and
+    # also extract the inputs & differing outputs.
     inputs = {}
-    for port in prog1.inputs.values():
-        prog1_val = model[f"prog1_{port.name}"]
-        prog2_val = model[f"prog2_{port.name}"]
+    for port in prog.inputs.values():
+        prog1_val = model[f"{prefix1}{port.name}"]
+        prog2_val = model[f"{prefix2}{port.name}"]
         assert prog1_val == prog2_val, "differing input"
         inputs[port.name] = prog1_val
     differing_outputs = {}
-    for port in prog1.outputs.values():
-        prog1_val = model[f"prog1_{port.name}"]
-        prog2_val = model[f"prog2_{port.name}"]
+    for port in prog.outputs.values():
+        prog1_val = model[f"{prefix1}{port.name}"]
+        prog2_val = model[f"{prefix2}{port.name}"]
         if prog1_val != prog2_val:
             differing_outputs[port.name] = (prog1_val, prog2_val)
     assert differing_outputs, "no differing outputs"
 
     return Counterexample(inputs, differing_outputs)
+
+
+def equiv_many(
+    prog: lang.Program, candidates: list[lang.Program]
+) -> list[Optional[Counterexample]]:
+    """Check several candidates for equivalence with one program.
+
+    The candidates share a single solver instance: the original program's
+    constraints are asserted once, and each candidate is checked in its own
+    solver scope.
+    """
+    results = []
+    with Environment():
+        env1 = symbol_env(prog, "prog1_")
+        with get_solver("z3") as solver:
+            solver.add_assertion(prog_env_formula(prog, env1))
+            for i, cand in enumerate(candidates):
+                env2 = symbol_env(cand, f"prog2_{i}_")
+                solver.push()
+                solver.add_assertion(prog_env_formula(cand, env2))
+                for phi in differ_formulas(prog, env1, env2):
+                    solver.add_assertion(phi)
+                if solver.solve():
+                    # Query values directly: pysmt's models for incremental
+                    # solvers only include symbols from the current scope.
+                    ports = list(prog.inputs) + list(prog.outputs)
+                    model = {
+                        s.symbol_name(): solver.get_value(s).bv2nat()
+                        for s in chain(
+                            (env1[p] for p in ports), (env2[p] for p in ports)
+                        )
+                    }
+                    results.append(
+                        counterexample(prog, model, "prog1_", f"prog2_{i}_")
+                    )
+                else:
+                    results.append(None)
+                solver.pop()
+    return results
@@ -0,0 +1,288 @@
+from . import lang, smt
+from .util import Env
+from pysmt.environment import Environment
+from pysmt.fnode import FNode
+from pysmt.shortcuts import And, Equals, BV, to_smtlib
+from pysmt.smtlib.printers import quote
+from collections.abc import AsyncIterator, Iterable
+from contextlib import asynccontextmanager
+from typing import Optional
+import asyncio
+import os
+import re
+import shutil
+
+VALUE_RE = re.compile(
+    r"\(\s*\|?([^\s|()]+)\|?\s+"
+    r"(?:#x([0-9a-fA-F]+)|#b([01]+)|\(_ bv(\d+) \d+\))\s*\)"
+)
+
+
+class SolverError(Exception):
+    pass
+
+
+class SolverTimeout(SolverError):
+    pass
+
+
+def declarations(env: smt.SymbolEnv) -> str:
+    return "".join(
+        f"(declare-fun {quote(s.symbol_name())} () "
+        f"(_ BitVec {s.bv_width()}))\n"
+        for s in env.values()
+    )
+
+
+def assertion(phi: FNode) -> str:
+    return f"(assert {to_smtlib(phi, daggify=True)})\n"
+
+
+def parse_values(text: str) -> Env:
+    """Parse the response to a `get-value` command."""
+    values = {}
+    for name, hex_val, bin_val, dec_val in VALUE_RE.findall(text):
+        if hex_val:
+            values[name] = int(hex_val, 16)
+        elif bin_val:
+            values[name] = int(bin_val, 2)
+        else:
+            values[name] = int(dec_val)
+    return values
+
+
+class Z3Process:
+    """A long-lived z3 process that answers SMT-LIB queries on its stdin."""
+
+    def __init__(self, proc: asyncio.subprocess.Process):
+        self.proc = proc
+        self.queries = 0
+
+    @classmethod
+    async def start(cls, command: list[str]) -> "Z3Process":
+        proc = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        return cls(proc)
+
+    async def send(self, text: str) -> None:
+        assert self.proc.stdin
+        self.proc.stdin.write(text.encode())
+        await self.proc.stdin.drain()
+
+    async def read(self) -> str:
+        """Read one response: a line, or a parenthesized s-expression."""
+        assert self.proc.stdout
+        out = ""
+        while True:
+            line = (await self.proc.stdout.readline()).decode()
+            if not line:
+                raise SolverError("solver exited")
+            out += line
+            if out.count("(") == out.count(")"):
+                break
+        if out.startswith("(error"):
+            raise SolverError(f"solver error: {out.strip()}")
+        return out.strip()
+
+    async def solve(self, script: str, names: Iterable[str]) -> Optional[Env]:
+        """Check some declarations and assertions in a scope of their own.
+
+        Return the values of some symbols if they are satisfiable. A single
+        scope is much faster than nested ones or a `(reset)`. Inside a scope,
+        though, plain `check-sat` uses z3's incremental solver, which is
+        hopeless on wide multiplication and division, so ask for the
+        bit-blasting tactic that a one-shot query gets.
+        """
+        self.queries += 1
+        await self.send(f"(push 1)\n{script}(check-sat-using qfbv)\n")
+        match await self.read():
+            case "sat":
+                names = list(names)
+                model = {}
+                if names:
+                    await self.send(
+                        f"(get-value ({' '.join(map(quote, names))}))\n"
+                    )
+                    model = parse_values(await self.read())
+            case "unsat":
+                model = None
+            case res:
+                raise SolverError(f"solver returned `{res}`")
+        await self.send("(pop 1)\n")
+        return model
+
+    def kill(self) -> None:
+        if self.proc.returncode is None:
+            self.proc.kill()
+
+
+class SolverPool:
+    """Check formulas on a pool of z3 processes, without blocking the loop.
+
+    Processes start on demand and are reused, so queries do not pay to start
+    a solver. At most `max_pending` queries may be queued or running at once.
+    A query that exceeds its timeout, or whose caller is cancelled, kills its
+    solver process, which is replaced on demand. So does answering `recycle`
+    queries, since z3 never frees some of what each query interns.
+    """
+
+    def __init__(
+        self,
+        size: Optional[int] = None,
+        timeout: Optional[float] = None,
+        max_pending: Optional[int] = None,
+        recycle: Optional[int] = None,
+    ):
+        self.size = size or os.cpu_count() or 1
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pending = asyncio.Semaphore(max_pending or 4 * self.size)
+        self.idle: list[Z3Process] = []
+        self.slots = asyncio.Semaphore(self.size)
+        self.procs: set[Z3Process] = set()
+        self.command = [shutil.which("z3") or "z3", "-smt2", "-in"]
+        self.keeper: Optional[asyncio.Task] = None
+
+    async def keep(self) -> None:
+        """Wait for the event loop to shut down, then stop the solvers.
+
+        `asyncio.run` cancels this task before closing the loop, which lets
+        the processes exit while the loop can still clean up after them.
+        """
+        try:
+            await asyncio.Future()
+        finally:
+            await self.aclose()
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[Z3Process]:
+        """Borrow a solver process with a fresh assertion stack."""
+        async with self.pending, self.slots:
+            proc = self.idle.pop() if self.idle else None
+            if proc is None:
+                if self.keeper is None:
+                    self.keeper = asyncio.create_task(self.keep())
+                proc = await Z3Process.start(self.command)
+                await proc.send("(set-logic QF_BV)\n")
+                self.procs.add(proc)
+            try:
+                yield proc
+            except BaseException:
+                # The process may be mid-query: never reuse it.
+                self.retire(proc)
+                raise
+            if self.recycle and proc.queries >= self.recycle:
+                self.retire(proc)
+            else:
+                self.idle.append(proc)
+
+    def retire(self, proc: Z3Process) -> None:
+        """Kill a process and forget it once it exits."""
+        proc.kill()
+        exited = asyncio.ensure_future(proc.proc.wait())
+        exited.add_done_callback(lambda _: self.procs.discard(proc))
+
+    async def solve(
+        self,
+        queries: list[tuple[str, list[str]]],
+        timeout: Optional[float] = None,
+    ) -> list[Optional[Env]]:
+        """Solve several scripts on one process, with a timeout for them all.
+
+        Each query is a script and the symbols whose values to get if the
+        script is satisfiable. The timeout starts once a process is free, so
+        time spent waiting in the queue does not count.
+        """
+
+        async def solve_all(proc: Z3Process) -> list[Optional[Env]]:
+            return [
+                await proc.solve(script, names) for script, names in queries
+            ]
+
+        async with self.session() as proc:
+            try:
+                return await asyncio.wait_for(
+                    solve_all(proc), timeout or self.timeout
+                )
+            except asyncio.TimeoutError:
+                raise SolverTimeout("solver timed out")
+
+    async def equiv(
+        self, prog1: lang.Program, prog2: lang.Program
+    ) -> Optional[smt.Counterexample]:
+        return (await self.equiv_many(prog1, [prog2]))[0]
+
+    async def equiv_many(
+        self, prog: lang.Program, candidates: list[lang.Program]
+    ) -> list[Optional[smt.Counterexample]]:
+        """Check several candidates for equivalence on one process."""
+        ports = list(prog.inputs) + list(prog.outputs)
+        names = [f"prog1_{p}" for p in ports] + [f"prog2_{p}" for p in ports]
+        queries = []
+        with Environment():
+            env1 = smt.symbol_env(prog, "prog1_")
+            base = declarations(env1) + assertion(
+                smt.prog_env_formula(prog, env1)
+            )
+            for cand in candidates:
+                env2 = smt.symbol_env(cand, "prog2_")
+                phi = And(
+                    smt.prog_env_formula(cand, env2),
+                    *smt.differ_formulas(prog, env1, env2),
+                )
+                queries.append(
+                    (base + declarations(env2) + assertion(phi), names)
+                )
+
+        return [
+            None
+            if model is None
+            else smt.counterexample(prog, model, "prog1_", "prog2_")
+            for model in await self.solve(queries)
+        ]
+
+    async def run(self, prog: lang.Program, env: Env) -> Env:
+        return (await self.run_many(prog, [env]))[0]
+
+    async def run_many(self, prog: lang.Program, envs: list[Env]) -> list[Env]:
+        """Run a program on several inputs on one process."""
+        for env in envs:
+            smt.check_input(prog, env)
+        names = list(prog.outputs)
+        with Environment():
+            symb_env, phi = smt.prog_formula(prog)
+            base = declarations(symb_env) + assertion(phi)
+            queries = [
+                (
+                    base
+                    + assertion(
+                        And(
+                            Equals(
+                                symb_env[var],
+                                BV(value, prog.inputs[var].width),
+                            )
+                            for var, value in env.items()
+                        )
+                    ),
+                    names,
+                )
+                for env in envs
+            ]
+
+        results = await self.solve(queries)
+        if any(model is None for model in results):
+            raise SolverError("solver found no outputs for the inputs")
+        return results  # type: ignore
+
+    async def aclose(self) -> None:
+        procs = list(self.procs)
+        self.procs.clear()
+        self.idle.clear()
+        self.keeper = None
+        for proc in procs:
+            proc.kill()
+        await asyncio.gather(*(proc.proc.wait() for proc in procs))
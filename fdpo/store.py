@@ -0,0 +1,144 @@
+from . import lang
+import sqlite3
+import hashlib
+import os
+import socket
+import time
+from typing import NamedTuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    prog_hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    method TEXT NOT NULL,
+    rep INTEGER NOT NULL,
+    prog TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    finished REAL,
+    best_cost INTEGER,
+    rounds INTEGER,
+    seconds REAL,
+    PRIMARY KEY (prog_hash, model, method, rep)
+);
+"""
+
+REPORT = """
+SELECT prog, model, method, COUNT(*),
+    SUM(best_cost >= 0),
+    AVG(CASE WHEN best_cost >= 0 THEN best_cost END),
+    MIN(CASE WHEN best_cost >= 0 THEN best_cost END),
+    AVG(CASE WHEN best_cost >= 0 THEN rounds END),
+    AVG(seconds)
+FROM results
+WHERE finished IS NOT NULL
+GROUP BY prog_hash, model, method
+ORDER BY prog, model, method
+"""
+
+
+def prog_hash(prog: lang.Program) -> str:
+    """Get a hash of a program that is stable across processes."""
+    return hashlib.sha256(prog.pretty().encode()).hexdigest()[:16]
+
+
+class Key(NamedTuple):
+    prog_hash: str
+    model: str
+    method: str
+    rep: int
+
+
+def _alive(owner: str) -> bool:
+    """Check whether the process that claimed a task may still be running.
+
+    We can only tell for processes on this host; assume others are alive.
+    """
+    host, pid = owner.rsplit(":", 1)
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ResultStore:
+    """A database of benchmark results, for resumable runs.
+
+    Each task is keyed by the program's hash, the model, the method, and the
+    repetition number. A process claims a task before running it, so several
+    processes can share a store without duplicating work. Claims left behind
+    by processes that died are taken over.
+    """
+
+    def __init__(self, path: str):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    def claim(self, key: Key, prog: str) -> bool:
+        """Try to claim a task, returning False if it is done or taken."""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute(
+                "SELECT owner, finished FROM results WHERE prog_hash = ? "
+                "AND model = ? AND method = ? AND rep = ?",
+                key,
+            ).fetchone()
+            if row is not None:
+                owner, finished = row
+                if finished is not None or owner == self.owner:
+                    return False
+                if _alive(owner):
+                    return False
+            self.db.execute(
+                "INSERT OR REPLACE INTO results "
+                "(prog_hash, model, method, rep, prog, owner) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, prog, self.owner),
+            )
+            return True
+        finally:
+            self.db.execute("COMMIT")
+
+    def put(self, key: Key, best_cost: int, rounds: int, seconds: float):
+        """Record the result of a claimed task."""
+        self.db.execute(
+            "UPDATE results SET finished = ?, best_cost = ?, rounds = ?, "
+            "seconds = ? WHERE prog_hash = ? AND model = ? AND method = ? "
+            "AND rep = ?",
+            (time.time(), best_cost, rounds, seconds, *key),
+        )
+
+    def release(self) -> None:
+        """Give up this process's claims on unfinished tasks."""
+        self.db.execute(
+            "DELETE FROM results WHERE owner = ? AND finished IS NULL",
+            (self.owner,),
+        )
+
+    def report(self) -> list[tuple]:
+        """Aggregate the results for each program, model, and method.
+
+        Each row has the program name, model, method, number of runs,
+        number of successes, mean and best cost and mean rounds (of
+        successes), and mean seconds.
+        """
+        return self.db.execute(REPORT).fetchall()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self) -> "ResultStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+        self.close()
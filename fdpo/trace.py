@@ -0,0 +1,142 @@
+import contextvars
+import gc
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from collections import Counter
+from collections.abc import Iterator
+from dataclasses import dataclass
+from typing import Optional, Any
+
+# The phases that get their own columns in benchmark output.
+PHASES = ["prefill", "generate", "render", "parse", "check", "equiv", "run"]
+
+
+@dataclass
+class Phase:
+    count: int = 0
+    seconds: float = 0.0
+
+
+class Trace:
+    """Time spent in each phase of some work, plus named counters.
+
+    Traces nest: time recorded in a trace is also recorded in its parent, so
+    a per-round trace also accumulates into a per-session trace.
+    """
+
+    def __init__(self, parent: Optional["Trace"] = None):
+        self.parent = parent
+        self.phases: dict[str, Phase] = {}
+        self.counters: Counter[str] = Counter()
+
+    def add(self, name: str, seconds: float) -> None:
+        phase = self.phases.setdefault(name, Phase())
+        phase.count += 1
+        phase.seconds += seconds
+        if self.parent:
+            self.parent.add(name, seconds)
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+        if self.parent:
+            self.parent.count(name, n)
+
+    def seconds(self, name: str) -> float:
+        phase = self.phases.get(name)
+        return phase.seconds if phase else 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        """Flatten the trace for a JSON record."""
+        out: dict[str, Any] = {}
+        for name, phase in self.phases.items():
+            out[f"{name}_s"] = round(phase.seconds, 6)
+            out[f"{name}_n"] = phase.count
+        out.update(self.counters)
+        return out
+
+    def columns(self) -> list[str]:
+        """Get the per-phase times for a CSV row (see `PHASES`)."""
+        return [f"{self.seconds(name):.3f}" for name in PHASES]
+
+
+CURRENT: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar(
+    "trace", default=None
+)
+
+
+@contextmanager
+def tracing(trace: Optional[Trace] = None) -> Iterator[Trace]:
+    """Record into a trace, by default a new one nested in the current one.
+
+    The current trace follows the `contextvars` context, so concurrent asyncio
+    tasks each record into their own trace.
+    """
+    if trace is None:
+        trace = Trace(CURRENT.get())
+    token = CURRENT.set(trace)
+    try:
+        yield trace
+    finally:
+        CURRENT.reset(token)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Record the wall-clock time of a phase in the current trace."""
+    trace = CURRENT.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+def record(name: str, seconds: float) -> None:
+    """Record a phase time that was measured elsewhere."""
+    if trace := CURRENT.get():
+        trace.add(name, seconds)
+
+
+def count(name: str, n: int = 1) -> None:
+    """Bump a counter in the current trace."""
+    if trace := CURRENT.get():
+        trace.count(name, n)
+
+
+def rss_kb() -> int:
+    """Get this process's resident memory in KiB.
+
+    Without `/proc`, fall back to the peak, which at least never shrinks.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def gauges() -> dict[str, int]:
+    """Measure this process's memory, live objects, and open files.
+
+    `objects` counts containers tracked by the garbage collector, and walks
+    the whole heap to do it, so call this occasionally. `blocks` counts all
+    memory blocks that Python has allocated, including strings.
+    """
+    out = {
+        "rss_kb": rss_kb(),
+        "objects": len(gc.get_objects()),
+        "blocks": sys.getallocatedblocks(),
+    }
+    try:
+        out["fds"] = len(os.listdir("/proc/self/fd"))
+    except OSError:
+        pass
+    return out
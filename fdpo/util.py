@@ -1,3 +1,11 @@
+import csv
+import importlib.util
+import json
+import sys
+import types
+from collections.abc import Iterator
+from typing import TextIO
+
 Env = dict[str, int]
 
 BASES = {"b": 2, "o": 8, "d": 10, "h": 16, "x": 16}
@@ -13,7 +21,10 @@ def parse_int(s: str) -> int:
         for base, radix in BASES.items():
             if base in s:
                 _, value = s.split(base, 1)
-                return int(value, radix)
+                try:
+                    return int(value, radix)
+                except ValueError:
+                    break
         raise ValueError(f"invalid integer: {s}")
 
 
@@ -25,6 +36,60 @@ def parse_env(args: list[str]) -> Env:
     }
 
 
+def parse_env_rows(args: list[str]) -> list[Env]:
+    """Parse several rows of values separated by semicolons, like
+    a=5 b=42; a=6 b=43.
+    """
+    rows: list[list[str]] = [[]]
+    for arg in args:
+        for i, part in enumerate(arg.split(";")):
+            if i:
+                rows.append([])
+            if part:
+                rows[-1].append(part)
+    return [parse_env(row) for row in rows if row] or [{}]
+
+
+def read_envs(f: TextIO, json_lines: bool = False) -> Iterator[Env]:
+    """Read rows of values from CSV (with a header) or JSON lines.
+
+    Raise ValueError, naming the line, for a malformed row.
+    """
+    if json_lines:
+        for num, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    yield {
+                        key: parse_int(str(value))
+                        for key, value in json.loads(line).items()
+                    }
+                except (ValueError, AttributeError) as e:
+                    raise ValueError(f"line {num}: {e}")
+    else:
+        reader = csv.DictReader(f)
+        for row in reader:
+            try:
+                if None in row or None in row.values():
+                    raise ValueError("wrong number of values")
+                yield {key: parse_int(value) for key, value in row.items()}
+            except ValueError as e:
+                raise ValueError(f"line {reader.line_num}: {e}")
+
+
 def env_str(env: Env) -> str:
     out = [f"{key} = {value}" for key, value in env.items()]
     return "\n".join(out)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Import a module, but only load it when one of its attributes is used."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    assert spec and spec.loader, f"module {name} not found"
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,125 @@
+from . import lang, smt, trace
+from .solver import SolverPool
+from .util import Env
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+from typing import Optional, TypeVar
+from collections.abc import Callable
+from pysmt.environment import reset_env
+
+T = TypeVar("T")
+
+
+def init_worker() -> None:
+    """Start a worker process with its own pristine pysmt environment.
+
+    Forked workers would otherwise inherit whatever global pysmt state the
+    parent had accumulated.
+    """
+    reset_env()
+
+
+class Verifier:
+    """An asynchronous front end for solver queries.
+
+    Solver calls run in a pool of worker processes, so they do not block the
+    event loop (and every other in-flight LLM stream) while they run. At
+    most `max_pending` queries may be queued or running at once; further
+    callers wait their turn. Cancelling a waiting coroutine withdraws its
+    query if it has not started yet.
+
+    With `solvers`, equivalence checks and runs instead go straight to a
+    pool of that many z3 processes (see `SolverPool`), which can also time
+    out and cancel queries that are already running. Worker processes
+    cannot, so `solver_timeout` requires `solvers`.
+
+    With `recycle`, each worker or solver process is replaced after that many
+    tasks, so whatever state they accumulate cannot grow without bound.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        solvers: Optional[int] = None,
+        solver_timeout: Optional[float] = None,
+        recycle: Optional[int] = None,
+    ):
+        if solver_timeout and not solvers:
+            raise ValueError("solver_timeout requires solvers")
+        self.workers = workers or os.cpu_count() or 1
+        options = {}
+        if recycle:
+            # Python will not fork replacement workers from a process that
+            # has threads by then, and a fork server is cheaper than spawning.
+            options = {
+                "max_tasks_per_child": recycle,
+                "mp_context": multiprocessing.get_context("forkserver"),
+            }
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, initializer=init_worker, **options
+        )
+        self.pending = asyncio.Semaphore(max_pending or 4 * self.workers)
+        self.solvers = (
+            SolverPool(solvers, solver_timeout, max_pending, recycle)
+            if solvers
+            else None
+        )
+
+    async def start(self) -> None:
+        """Start the worker processes now, not on the first query.
+
+        Workers are forked, so starting them early keeps them from
+        inheriting file descriptors (like client connections) opened later.
+        """
+        await self.submit(os.getpid)
+
+    async def submit(self, func: Callable[..., T], *args) -> T:
+        """Run a function in a worker process."""
+        async with self.pending:
+            fut = self.pool.submit(func, *args)
+            try:
+                return await asyncio.wrap_future(fut)
+            except asyncio.CancelledError:
+                fut.cancel()
+                raise
+
+    async def equiv(
+        self, prog1: lang.Program, prog2: lang.Program
+    ) -> Optional[smt.Counterexample]:
+        with trace.span("equiv"):
+            if self.solvers:
+                return await self.solvers.equiv(prog1, prog2)
+            return await self.submit(smt.equiv, prog1, prog2)
+
+    async def equiv_many(
+        self, prog: lang.Program, candidates: list[lang.Program]
+    ) -> list[Optional[smt.Counterexample]]:
+        with trace.span("equiv"):
+            trace.count("equiv_candidates", len(candidates))
+            if self.solvers:
+                return await self.solvers.equiv_many(prog, candidates)
+            return await self.submit(smt.equiv_many, prog, candidates)
+
+    async def run(self, prog: lang.Program, env: Env) -> Env:
+        with trace.span("run"):
+            if self.solvers:
+                return await self.solvers.run(prog, env)
+            return await self.submit(smt.run, prog, env)
+
+    async def run_many(self, prog: lang.Program, envs: list[Env]) -> list[Env]:
+        with trace.span("run"):
+            if self.solvers:
+                return await self.solvers.run_many(prog, envs)
+            return await self.submit(smt.run_many, prog, envs)
+
+    def close(self) -> None:
+        self.pool.shutdown(cancel_futures=True)
+
+    def __enter__(self) -> "Verifier":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
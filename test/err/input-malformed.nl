@@ -0,0 +1,4 @@
+# ARGS: x=4xzz
+in x: 4;
+out y: 4;
+y = x;
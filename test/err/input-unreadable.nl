@@ -0,0 +1,4 @@
+# ARGS: --inputs test/err/missing-vectors.csv
+in x: 4;
+out y: 4;
+y = x;
@@ -0,0 +1 @@
+# ARGS: --size 30 --seed 3
@@ -0,0 +1 @@
+# ARGS: --size 30 --seed 3 --widths 4,8 --ops add,sub=2,mul,xor,if,slice
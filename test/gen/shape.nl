@@ -0,0 +1 @@
+# ARGS: --size 40 --seed 2 --outputs 3 --window 4 --max-depth 6 --max-fanout 2
@@ -0,0 +1 @@
+# ARGS: --size 12 --seed 1